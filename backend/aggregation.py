@@ -0,0 +1,128 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AggregationWorker:
+    """
+    Fits client updates off the request path and queues them for the global
+    model's FedAvg rounds.
+
+    Request handlers call `submit`, which never blocks: when the queue is full
+    the update is dropped and counted, so a slow worker shows up as
+    backpressure in `metrics()` instead of as write latency. Aggregation is
+    triggered once `min_clients` updates are pending, or when
+    `window_seconds` (if set) has passed since the last round with at least
+    one update pending. Every poll also syncs the model, so a process that
+    does not aggregate picks up models published by the one that does.
+    """
+
+    def __init__(self, model, fit_update, min_clients=10, window_seconds=0.0, max_queue=10000):
+        self.model = model
+        self.fit_update = fit_update
+        self.min_clients = min_clients
+        self.window_seconds = window_seconds
+        self.max_queue = max_queue
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = threading.Event()
+
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.aggregations = 0
+        self.high_water = 0
+        self.fit_seconds = 0.0
+        self._last_aggregation = time.monotonic()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="aggregation-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, data) -> bool:
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        self.high_water = max(self.high_water, self._queue.qsize())
+        return True
+
+    def _poll_timeout(self):
+        if self.window_seconds > 0:
+            return min(self.window_seconds, 1.0)
+        return 1.0
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                data = self._queue.get(timeout=self._poll_timeout())
+            except queue.Empty:
+                data = None
+            if data is not None:
+                self._process(data)
+                self._queue.task_done()
+            try:
+                self._maybe_aggregate()
+            except Exception as e:
+                logger.error(f"Federated aggregation failed: {str(e)}")
+
+    def _process(self, data):
+        started = time.perf_counter()
+        try:
+            coef, intercept = self.fit_update(data)
+            self.model.add_update(coef, intercept)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Federated update failed: {str(e)}")
+        finally:
+            self.fit_seconds += time.perf_counter() - started
+
+    def _maybe_aggregate(self):
+        self.model.sync()
+        pending = self.model.pending_updates
+        if pending >= self.min_clients:
+            min_clients = self.min_clients
+        elif (self.window_seconds > 0 and pending > 0
+              and time.monotonic() - self._last_aggregation >= self.window_seconds):
+            min_clients = 1
+        else:
+            return
+        if self.model.aggregate_updates(min_clients=min_clients):
+            self.aggregations += 1
+            self._last_aggregation = time.monotonic()
+
+    def drain(self):
+        """Block until every queued update has been fitted and aggregated if due."""
+        self._queue.join()
+        self._maybe_aggregate()
+
+    def metrics(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self.max_queue,
+            "queue_high_water": self.high_water,
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "failed": self.failed,
+            "pending_updates": self.model.pending_updates,
+            "aggregations": self.aggregations,
+            "fit_seconds_total": self.fit_seconds,
+            "seconds_since_aggregation": time.monotonic() - self._last_aggregation,
+        }
@@ -1,16 +1,27 @@
+import time
+_import_started = time.perf_counter()
+
 import os
 import json
+import math
 import logging
 import hashlib
-import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pandas as pd
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import (Blueprint, Flask, Response, current_app, g, request, jsonify, render_template,
+                   send_from_directory, stream_with_context)
 from flask_cors import CORS
-from cryptography.fernet import Fernet
-from sklearn.linear_model import LinearRegression
-from sklearn.cluster import KMeans
-from synthetic_data import generate_synthetic_clients  # Ensure this module exists
+from segmentation import SegmentationEngine
+from sharded_segmentation import SegmentationJob, ShardedKMeans
+from aggregation import AggregationWorker
+from user_store import open_user_store
+from codec import Keyring, RecordCodec
+from response_cache import GenerationCounter, ResponseCache
+from model_updates import decode_update, encode_update, max_payload_size
+from model_registry import ModelHistory, decode_model, encode_model
+from metrics import Registry, SamplingProfiler
 
 # Determine the base directory (one level up from backend)
 basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -19,51 +30,208 @@ basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 template_dir = os.path.join(basedir, "templates")
 static_dir = os.path.join(basedir, "frontend/build/static")
 
-app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
-CORS(app)
-app.logger.setLevel(logging.INFO)
+# Routes are registered on the app built by create_app(). Nothing expensive
+# happens at import time: scikit-learn is imported on first use and the
+# keyring, store and caches are set up by init_state().
+api = Blueprint("api", __name__)
+# The same logger as the Flask app's, which is named after this module
+logger = logging.getLogger(__name__)
 
 # Configuration
 FEDERATION_ROUNDS = 5
 MIN_CLIENTS_FOR_AGGREGATION = 10
-MODEL_VERSION = "1.0"
+MODEL_HISTORY_SIZE = int(os.getenv("MODEL_HISTORY_SIZE", "8"))
+MODEL_BINARY_MIMETYPE = "application/octet-stream"
+MODEL_INPUT_DIM = int(os.getenv("MODEL_INPUT_DIM", "2"))
+# Names of the global model and of its pending client updates in the user store
+MODEL_STATE = "model"
+MODEL_UPDATES = "model_updates"
 ANONYMIZATION_SALT = os.getenv("ANONYMIZATION_SALT", "default-secret-salt")
+SEGMENT_COUNT = 5
+SEGMENT_REFIT_INTERVAL = float(os.getenv("SEGMENT_REFIT_INTERVAL", "300"))
+SEGMENT_DRIFT_THRESHOLD = float(os.getenv("SEGMENT_DRIFT_THRESHOLD", "1.5"))
+# Seconds between checks of the background refit job; 0 refits inline on reads instead
+SEGMENT_JOB_INTERVAL = float(os.getenv("SEGMENT_JOB_INTERVAL", "5"))
+SEGMENT_REFIT_WORKERS = int(os.getenv("SEGMENT_REFIT_WORKERS", str(os.cpu_count() or 1)))
+SEGMENT_MIN_SHARD_ROWS = int(os.getenv("SEGMENT_MIN_SHARD_ROWS", "50000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+ENCRYPTION_WORKERS = int(os.getenv("ENCRYPTION_WORKERS", str(os.cpu_count() or 1)))
+AGGREGATION_QUEUE_SIZE = int(os.getenv("AGGREGATION_QUEUE_SIZE", "10000"))
+AGGREGATION_WINDOW_SECONDS = float(os.getenv("AGGREGATION_WINDOW_SECONDS", "0"))
+USER_STORE_PATH = os.getenv("USER_STORE_PATH", "users.db")
+STORE_SCAN_BATCH = int(os.getenv("STORE_SCAN_BATCH", "10000"))
+# Catch-ups larger than this are applied as bulk column loads instead of per-user upserts
+STORE_BULK_SYNC_ROWS = int(os.getenv("STORE_BULK_SYNC_ROWS", "5000"))
+ASSIGNMENTS_PAGE_SIZE = int(os.getenv("ASSIGNMENTS_PAGE_SIZE", "1000"))
+ASSIGNMENTS_MAX_PAGE_SIZE = 10000
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0").lower() in ("1", "true", "yes")
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))
 
 # Encryption setup
+# secret.key is the Fernet key of the original record format; it is only
+# needed to read records written before the versioned codec.
 KEY_FILE = "secret.key"
+KEYRING_FILE = os.getenv("KEYRING_FILE", "keyring.json")
 def load_key():
     if os.path.exists(KEY_FILE):
         with open(KEY_FILE, "rb") as f:
             return f.read()
-    new_key = Fernet.generate_key()
-    with open(KEY_FILE, "wb") as f:
-        f.write(new_key)
-    return new_key
+    return None
+
+# Set up by init_state()
+codec = None
+user_store = None
+segmentation = None
+segmentation_job = None
+
+# Threads do not survive a fork, so each process gets its own pool
+_encryption_pool = None
+_encryption_pool_pid = None
+_encryption_pool_lock = threading.Lock()
 
-key = load_key()
-cipher = Fernet(key)
+def get_encryption_pool() -> ThreadPoolExecutor:
+    global _encryption_pool, _encryption_pool_pid
+    if _encryption_pool_pid != os.getpid():
+        with _encryption_pool_lock:
+            if _encryption_pool_pid != os.getpid():
+                _encryption_pool = ThreadPoolExecutor(max_workers=ENCRYPTION_WORKERS)
+                _encryption_pool_pid = os.getpid()
+    return _encryption_pool
+
+# Instrumentation, exported at /api/metrics
+metrics = Registry()
+request_seconds = metrics.histogram(
+    "dataprivacy_request_seconds", "Request handling time by route", ["route", "method", "status"])
+stage_seconds = metrics.histogram(
+    "dataprivacy_stage_seconds", "Time spent in each stage of an operation", ["operation", "stage"])
+federation_submissions = metrics.counter(
+    "dataprivacy_federation_submissions_total", "Client updates offered to the aggregation queue", ["result"])
+# Sampling profiler, off unless PROFILER_ENABLED is set; see /api/metrics/profile
+profiler = SamplingProfiler(PROFILER_INTERVAL) if PROFILER_ENABLED else None
 
 # Federated Learning Model
 class FederatedLearningModel:
-    def __init__(self):
-        self.global_model = None
-        self.client_updates = []
-        self.model_version = MODEL_VERSION
-
-    def initialize_global_model(self, input_dim):
-        self.global_model = LinearRegression()
-        self.global_model.coef_ = np.zeros(input_dim)
-        self.global_model.intercept_ = 0.0
-
-    def aggregate_updates(self):
-        if len(self.client_updates) < MIN_CLIENTS_FOR_AGGREGATION:
-            app.logger.warning("Not enough clients for aggregation")
+    """
+    Global linear model shared by every process using the user store. Any
+    process queues client updates in the store; the one holding the store's
+    model lock aggregates them and publishes the result as the store's model
+    state, which the others adopt on their next sync(). Every worker thus
+    serves the same model under the same version.
+    """
+
+    def __init__(self, input_dim=MODEL_INPUT_DIM):
+        # Global linear model as plain arrays; None until initialized
+        self.coef = None
+        self.intercept = 0.0
+        self.input_dim = input_dim
+        # Version of the model state in the store; 0 until a model exists
+        self.history = ModelHistory(MODEL_HISTORY_SIZE)
+        self.model_version = 0
+        self.store = None
+        self._lock = threading.Lock()
+        self._aggregate_lock = threading.Lock()
+
+    def initialize_global_model(self, input_dim, store):
+        """Adopt the model in the store, or publish a zero model if there is none yet."""
+        self.input_dim = input_dim
+        self.store = store
+        self.coef = None
+        self.model_version = 0
+        if not self.sync():
+            self._publish(np.zeros(input_dim), 0.0)
+
+    def _global_params(self):
+        if self.coef is None:
+            return np.zeros(self.input_dim), 0.0
+        return self.coef, self.intercept
+
+    def _install(self, version, coef, intercept):
+        with self._lock:
+            # A newer model may already have been installed by another thread
+            if version <= self.model_version:
+                return False
+            self.coef = coef
+            self.intercept = intercept
+            self.model_version = self.history.publish(coef, intercept, version)
+        segmentation.set_model(coef, intercept)
+        data_generation.bump()
+        return True
+
+    def _publish(self, coef, intercept):
+        version = self.store.put_state(MODEL_STATE, encode_model(coef, intercept))
+        self._install(version, coef, intercept)
+
+    def sync(self) -> bool:
+        """Adopt a model published to the store by another process, if there is one."""
+        state = self.store.get_state(MODEL_STATE, since=self.model_version)
+        if state is None:
             return False
-        avg_coef = np.mean([update["coef"] for update in self.client_updates], axis=0)
-        avg_intercept = np.mean([update["intercept"] for update in self.client_updates])
-        self.global_model.coef_ = avg_coef
-        self.global_model.intercept_ = avg_intercept
-        self.client_updates = []
+        version, payload = state
+        coef, intercept = decode_model(payload)
+        if len(coef) != self.input_dim:
+            # Published by a process configured with another MODEL_INPUT_DIM
+            return False
+        return self._install(version, coef, intercept)
+
+    @property
+    def pending_updates(self) -> int:
+        return self.store.count_messages(MODEL_UPDATES) if self.store is not None else 0
+
+    def add_update(self, coef, intercept, weight=1.0):
+        """
+        Queue a locally trained model (dense coefficients) as its difference
+        from the current global model.
+        """
+        coef = np.asarray(coef, dtype=np.float64)
+        if len(coef) != self.input_dim:
+            raise ValueError(f"Expected {self.input_dim} coefficients, got {len(coef)}")
+        base_coef, base_intercept = self._global_params()
+        payload, _ = encode_update(coef - base_coef, intercept - base_intercept, dtype="float32", weight=weight)
+        self.add_encoded_update(payload)
+
+    def add_encoded_update(self, payload: bytes) -> int:
+        """
+        Queue a client's change to the global model in the model_updates.py
+        format, already validated by decode_update(). It is stored as sent, so
+        a sparse update costs space proportional to the number of values sent.
+        Returns the number of updates now pending.
+        """
+        with stage_seconds.time(operation="process_federated_update", stage="queue"):
+            return self.store.push_message(MODEL_UPDATES, payload)
+
+    def aggregate_updates(self, min_clients=MIN_CLIENTS_FOR_AGGREGATION):
+        with stage_seconds.time(operation="process_federated_update", stage="aggregate"):
+            return self._aggregate_updates(min_clients)
+
+    def _aggregate_updates(self, min_clients):
+        # Only one process aggregates, so every update is applied once
+        if not self.store.acquire_lock(MODEL_STATE):
+            return False
+        with self._aggregate_lock:
+            # Build on the latest model, even if a previous owner published it
+            self.sync()
+            if self.pending_updates < min_clients:
+                logger.warning("Not enough clients for aggregation")
+                return False
+            # FedAvg over deltas: the global model moves by the weighted mean
+            # change, with unsent coefficients of sparse updates counting as 0
+            coef_sum = np.zeros(self.input_dim, dtype=np.float64)
+            intercept_sum = weight_sum = 0.0
+            for payload in self.store.take_messages(MODEL_UPDATES):
+                update = decode_update(payload)
+                if update.dim != self.input_dim:
+                    logger.error(f"Dropping update of dimension {update.dim}, expected {self.input_dim}")
+                    continue
+                if update.indices is None:
+                    coef_sum += update.weight * update.values
+                else:
+                    coef_sum[update.indices] += update.weight * update.values
+                intercept_sum += update.weight * update.intercept
+                weight_sum += update.weight
+            if not weight_sum:
+                return False
+            base_coef, base_intercept = self._global_params()
+            self._publish(base_coef + coef_sum / weight_sum, base_intercept + intercept_sum / weight_sum)
         return True
 
 fl_model = FederatedLearningModel()
@@ -71,32 +239,58 @@ fl_model = FederatedLearningModel()
 def anonymize_user_id(user_id: str) -> str:
     return hashlib.sha256((user_id + ANONYMIZATION_SALT).encode()).hexdigest()
 
-user_data = {}
-clients = generate_synthetic_clients(100)
+def anonymize_user_ids(user_ids: list) -> list:
+    salt = ANONYMIZATION_SALT.encode()
+    sha256 = hashlib.sha256
+    return [sha256(uid.encode() + salt).hexdigest() for uid in user_ids]
+
+# Encrypted records live in the shared store; the segmentation engine holds
+# the plaintext numeric features and is kept in sync with the store.
+store_lock = threading.Lock()
+store_seq = 0
+
+# Bumped on every write and model change; cached API responses are keyed on it
+data_generation = GenerationCounter()
+response_cache = ResponseCache()
 
 # We'll no longer use a numerical interest mapping in process_user_data.
 # interest_map can still be used for other purposes if needed.
 interest_map = {"tech": 1, "finance": 2, "sports": 3, "health": 4, "education": 5}
 
+@api.before_app_request
+def start_request_timer():
+    start_background_workers()
+    g.request_started = time.perf_counter()
+
+@api.after_app_request
+def record_request_time(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # Label by URL rule, not path, to keep the number of series bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(time.perf_counter() - started, route=route,
+                                method=request.method, status=str(response.status_code))
+    return response
+
 # Serve Static Files
-@app.route("/static/<path:path>")
+@api.route("/static/<path:path>")
 def serve_static(path):
     return send_from_directory(static_dir, path)
 
-@app.route("/")
+@api.route("/")
 def serve_index():
     return render_template("index.html")
 
-@app.route("/dashboard")
+@api.route("/dashboard")
 def serve_dashboard():
     return render_template("Dashboard.html")
 
-@app.route("/favicon.ico")
+@api.route("/favicon.ico")
 def favicon():
-    return send_from_directory(os.path.join(app.root_path, "static"), "favicon.ico")
+    return send_from_directory(os.path.join(current_app.root_path, "static"), "favicon.ico")
 
 # API Routes
-@app.route("/api/save-preferences", methods=["POST"])
+@api.route("/api/save-preferences", methods=["POST"])
 def save_preferences():
     raw_user_id = request.headers.get("X-User-ID")
     if not raw_user_id:
@@ -106,17 +300,168 @@ def save_preferences():
     if not data or "prefs" not in data:
         return jsonify({"error": "Invalid data format"}), 400
     try:
-        processed_data = process_user_data(data["prefs"])
-        encrypted_data = encrypt_data(processed_data)
-        user_data[user_id] = encrypted_data
+        with stage_seconds.time(operation="save_preferences", stage="process"):
+            processed_data = process_user_data(data["prefs"])
+    except ValueError:
+        return jsonify({"error": "Invalid data format"}), 400
+    try:
+        with stage_seconds.time(operation="save_preferences", stage="encrypt"):
+            encrypted_data = encrypt_data(processed_data)
+        with stage_seconds.time(operation="save_preferences", stage="store"):
+            seq = user_store.put(user_id, encrypted_data)
+        with stage_seconds.time(operation="save_preferences", stage="segment"):
+            segmentation.upsert(user_id, processed_data["budget"], processed_data["interests"])
+        mark_synced(seq, seq)
+        data_generation.bump()
 
-        if process_federated_update(user_id, encrypted_data):
-            return jsonify({"status": "success", "federation": "update_accepted"})
-        return jsonify({"status": "success", "federation": "update_queued"})
+        with stage_seconds.time(operation="save_preferences", stage="federated_update"):
+            queued = process_federated_update(user_id, processed_data)
+        if queued:
+            return jsonify({"status": "success", "federation": "update_queued"})
+        # The aggregation queue is full; the preferences are saved but this
+        # client's update is shed to keep write latency bounded.
+        return jsonify({"status": "success", "federation": "update_dropped"})
     except Exception as e:
-        app.logger.error(f"Processing failed: {str(e)}")
+        logger.error(f"Processing failed: {str(e)}")
         return jsonify({"error": "Processing failed"}), 500
 
+def parse_batch_records(records: list, start: int):
+    """
+    Validate a chunk of raw batch records and compute their budgets with NumPy.
+    Returns the valid entries plus per-record errors keyed by index.
+    """
+    valid, errors = [], {}
+    lows, highs = [], []
+    for offset, record in enumerate(records):
+        index = start + offset
+        if not isinstance(record, dict):
+            errors[index] = "Invalid data format"
+            continue
+        if not isinstance(record.get("user_id"), str) or not record["user_id"]:
+            errors[index] = "Missing user ID"
+            continue
+        try:
+            prefs = record["prefs"]
+            low, high = (float(value) for value in prefs["budget"])
+            interests = prefs.get("interests", [])
+            if not isinstance(interests, list) or not all(isinstance(name, str) for name in interests):
+                raise TypeError("interests must be a list of strings")
+        except (KeyError, TypeError, ValueError, AttributeError):
+            errors[index] = "Invalid data format"
+            continue
+        lows.append(low)
+        highs.append(high)
+        valid.append((index, record["user_id"], interests))
+    # Infinite or NaN budgets, or ranges whose average overflows, would be
+    # stored but break the running stats and every later refit
+    with np.errstate(over="ignore", invalid="ignore"):
+        budgets = (np.array(lows, dtype=np.float64) + np.array(highs, dtype=np.float64)) / 2
+    finite = np.isfinite(budgets)
+    if not finite.all():
+        for position in np.flatnonzero(~finite).tolist():
+            errors[valid[position][0]] = "Invalid data format"
+        valid = [entry for entry, keep in zip(valid, finite.tolist()) if keep]
+        budgets = budgets[finite]
+    return valid, budgets, errors
+
+def ingest_batch(records: list, start: int = 0) -> tuple:
+    """Process one chunk of batch records and return (results, dropped_updates)."""
+    valid, budgets, errors = parse_batch_records(records, start)
+    results = [{"index": index, "status": "error", "error": message} for index, message in errors.items()]
+    if not valid:
+        return results, 0
+
+    user_ids = anonymize_user_ids([raw_user_id for _, raw_user_id, _ in valid])
+    processed = [
+        {"budget": budget, "interests": interests}
+        for budget, (_, _, interests) in zip(budgets.tolist(), valid)
+    ]
+    encrypted = encrypt_many(processed)
+    first, last = user_store.put_many(zip(user_ids, encrypted))
+    segmentation.upsert_many(user_ids, budgets, [record["interests"] for record in processed])
+    mark_synced(first, last)
+    data_generation.bump()
+
+    # The plaintext is already at hand, so the federated update never has to
+    # decrypt what was just encrypted.
+    dropped = 0
+    for user_id, record in zip(user_ids, processed):
+        if not process_federated_update(user_id, record):
+            dropped += 1
+    results.extend({"index": index, "status": "success"} for index, _, _ in valid)
+    results.sort(key=lambda result: result["index"])
+    return results, dropped
+
+def iter_ndjson_chunks(stream, chunk_size: int):
+    """Yield (start_index, records) chunks from an NDJSON request body."""
+    chunk, start, index = [], 0, 0
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            chunk.append(json.loads(line))
+        except ValueError:
+            # Keep the slot so the client can match the error to its line
+            chunk.append(None)
+        index += 1
+        if len(chunk) >= chunk_size:
+            yield start, chunk
+            chunk, start = [], index
+    if chunk:
+        yield start, chunk
+
+@api.route("/api/save-preferences/batch", methods=["POST"])
+def save_preferences_batch():
+    """
+    Bulk ingestion. Accepts either a JSON body {"records": [{"user_id", "prefs"}, ...]}
+    or an NDJSON stream with one record per line (Content-Type: application/x-ndjson).
+    NDJSON requests are answered with an NDJSON stream of per-record results
+    followed by a summary line.
+    """
+    if request.mimetype == "application/x-ndjson":
+        def generate():
+            accepted = rejected = dropped = 0
+            for start, chunk in iter_ndjson_chunks(request.stream, BATCH_CHUNK_SIZE):
+                try:
+                    results, chunk_dropped = ingest_batch(chunk, start)
+                except Exception as e:
+                    logger.error(f"Batch processing failed: {str(e)}")
+                    results = [{"index": start + i, "status": "error", "error": "Processing failed"} for i in range(len(chunk))]
+                    chunk_dropped = 0
+                dropped += chunk_dropped
+                for result in results:
+                    if result["status"] == "success":
+                        accepted += 1
+                    else:
+                        rejected += 1
+                yield "".join(json.dumps(result) + "\n" for result in results)
+            yield json.dumps({"status": "complete", "accepted": accepted, "rejected": rejected,
+                              "federation_dropped": dropped}) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get("records"), list):
+        return jsonify({"error": "Invalid data format"}), 400
+    records = data["records"]
+    try:
+        results, dropped = [], 0
+        for start in range(0, len(records), BATCH_CHUNK_SIZE):
+            chunk_results, chunk_dropped = ingest_batch(records[start:start + BATCH_CHUNK_SIZE], start)
+            results.extend(chunk_results)
+            dropped += chunk_dropped
+    except Exception as e:
+        logger.error(f"Batch processing failed: {str(e)}")
+        return jsonify({"error": "Processing failed"}), 500
+    accepted = sum(1 for result in results if result["status"] == "success")
+    return jsonify({
+        "status": "success",
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "federation_dropped": dropped,
+        "results": results,
+    })
+
 def get_recommended_product(seg_mean):
     """
     Return a product recommendation based on the segment's average budget.
@@ -131,122 +476,569 @@ def get_recommended_product(seg_mean):
     else:
         return "Budget Earbuds"
 
-@app.route("/api/segments")
+def segment_detail(seg: int, seg_stats: dict) -> dict:
+    """Describe one segment, with a product recommendation."""
+    seg_median = seg_stats["median"]
+    seg_mean = seg_stats["mean"]
+    return {
+        "segmentId": int(seg),
+        "description": f"This segment has an average budget of ${seg_mean:.2f} with a median of ${seg_median:.2f}.",
+        "preferences": seg_stats["common_interest"],  # Most common interest in this segment
+        "avgTargetPrice": seg_mean,
+        "recommendedProduct": get_recommended_product(seg_mean),
+        "size": seg_stats["count"],
+    }
+
+def build_segments_response() -> tuple:
+    if not len(segmentation):
+        return {"error": "No user data available"}, 400
+
+    # Labels and statistics are maintained incrementally on every write,
+    # so building the response does not depend on the number of users.
+    # Per-user assignments are served separately by /api/segments/assignments.
+    # The snapshot includes the KMeans refit when one is due.
+    with stage_seconds.time(operation="get_segments", stage="snapshot"):
+        overall, segment_stats = segmentation.snapshot()
+
+    return {
+        "segmentCounts": {str(seg): seg_stats["count"] for seg, seg_stats in segment_stats.items()},
+        "model_version": fl_model.model_version,
+        "participants": len(segmentation),
+        "stats": {
+            "average_budget": overall["mean"],
+            "median_budget": overall["median"],
+            "std_budget": overall["std"],
+            "min_budget": overall["min"],
+            "max_budget": overall["max"],
+            "common_interests": overall["common_interest"]
+        },
+        # Build detailed segment information with product recommendations
+        "segmentDetails": [segment_detail(seg, seg_stats) for seg, seg_stats in segment_stats.items()]
+    }, 200
+
+def cached_response(key: str, compute) -> Response:
+    """
+    Serve a response from the generation cache, answering If-None-Match
+    with 304 when the client already has the current body.
+    """
+    entry = response_cache.get(key, data_generation.value, compute)
+    if entry.status == 200 and request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, status=entry.status, mimetype="application/json")
+    response.set_etag(entry.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@api.route("/api/segments")
 def get_segments():
     try:
-        if not user_data:
-            return jsonify({"error": "No user data available"}), 400
-
-        decrypted_data = [decrypt_data(data) for data in user_data.values()]
-        df = pd.DataFrame(decrypted_data)
-
-        # Detailed statistics for budgets
-        avg_budget = float(df["budget"].mean())
-        median_budget = float(df["budget"].median())
-        std_budget = float(df["budget"].std())
-        min_budget = float(df["budget"].min())
-        max_budget = float(df["budget"].max())
-
-        # Compute overall common interest across all users:
-        # Since interests are now stored as lists, we flatten them.
-        all_interests = list(itertools.chain.from_iterable(df["interests"].tolist()))
-        common_interest = pd.Series(all_interests).mode()[0] if all_interests else "N/A"
-
-        df_numeric = df[["budget"]].copy()
-        # For clustering, we still use a numeric representation for interests.
-        # One simple approach is to count the number of interests selected.
-        df_numeric["interest_count"] = df["interests"].apply(len)
-
-        if fl_model.global_model:
-            df_numeric["prediction"] = fl_model.global_model.predict(df_numeric)
-            clusters = KMeans(n_clusters=5, random_state=42).fit_predict(df_numeric)
-        else:
-            clusters = KMeans(n_clusters=5, random_state=42).fit_predict(df_numeric)
+        with stage_seconds.time(operation="get_segments", stage="sync"):
+            sync_user_store()
+        with stage_seconds.time(operation="get_segments", stage="respond"):
+            return cached_response("segments", build_segments_response)
+    except Exception as e:
+        logger.error(f"Segmentation failed: {str(e)}")
+        return jsonify({"error": "Segmentation failed"}), 500
 
-        # Build detailed segment information with product recommendations
-        segment_details = []
-        unique_segments = np.unique(clusters)
-        for seg in unique_segments:
-            seg_mask = clusters == seg
-            seg_budget = df.loc[seg_mask, "budget"]
-            seg_median = seg_budget.median() if not seg_budget.empty else 0
-            seg_mean = seg_budget.mean() if not seg_budget.empty else 0
-            # For each segment, compute the most common interest.
-            seg_interests = list(itertools.chain.from_iterable(df.loc[seg_mask, "interests"].tolist()))
-            seg_common_interest = pd.Series(seg_interests).mode()[0] if seg_interests else "N/A"
-            recommended_product = get_recommended_product(seg_mean)
-            segment_details.append({
-                "segmentId": int(seg),
-                "description": f"This segment has an average budget of ${seg_mean:.2f} with a median of ${seg_median:.2f}.",
-                "preferences": seg_common_interest,  # Most common interest in this segment
-                "avgTargetPrice": seg_mean,
-                "recommendedProduct": recommended_product
-            })
+@api.route("/api/segments/assignments")
+def get_segment_assignments():
+    """
+    Segment label of every user, ordered by pseudonymized user ID. Returns one
+    page per request (?cursor=<next_cursor>&limit=<n>), or streams everything
+    after the cursor as NDJSON when the client accepts application/x-ndjson.
+    The cursor is the last user ID of the previous page, so paging stays
+    consistent when requests are served by different workers.
+    """
+    cursor = request.args.get("cursor") or None
+    try:
+        limit = int(request.args.get("limit", ASSIGNMENTS_PAGE_SIZE))
+        if cursor is not None and len(bytes.fromhex(cursor)) != 32:
+            raise ValueError("Cursor is not a user ID")
+    except ValueError:
+        return jsonify({"error": "Invalid cursor or limit"}), 400
+    if limit <= 0:
+        return jsonify({"error": "Invalid cursor or limit"}), 400
+    limit = min(limit, ASSIGNMENTS_MAX_PAGE_SIZE)
+    sync_user_store()
+
+    if request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        def generate():
+            after = cursor
+            while True:
+                user_ids, labels, _ = segmentation.labels_page(after, ASSIGNMENTS_MAX_PAGE_SIZE)
+                if not user_ids:
+                    return
+                yield "".join(f'{{"cursor":"{user_id}","segment":{label}}}\n'
+                              for user_id, label in zip(user_ids, labels.tolist()))
+                after = user_ids[-1]
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    user_ids, labels, total = segmentation.labels_page(cursor, limit)
+    # A full page may be the last one; the next request then returns no users
+    return jsonify({
+        "segments": labels.tolist(),
+        "cursor": cursor,
+        "next_cursor": user_ids[-1] if len(user_ids) == limit else None,
+        "total": total,
+        "model_version": fl_model.model_version,
+    })
 
+@api.route("/api/segments/me")
+def get_my_segment():
+    raw_user_id = request.headers.get("X-User-ID")
+    if not raw_user_id:
+        return jsonify({"error": "Missing user ID"}), 400
+    try:
+        sync_user_store()
+        found = segmentation.user_segment(anonymize_user_id(raw_user_id))
+        if found is None:
+            return jsonify({"error": "No preferences saved for this user"}), 404
+        segment, seg_stats = found
         return jsonify({
-            "segments": clusters.tolist(),
+            "segment": segment_detail(segment, seg_stats) if seg_stats else {"segmentId": segment},
             "model_version": fl_model.model_version,
-            "participants": len(user_data),
-            "stats": {
-                "average_budget": avg_budget,
-                "median_budget": median_budget,
-                "std_budget": std_budget,
-                "min_budget": min_budget,
-                "max_budget": max_budget,
-                "common_interests": common_interest
-            },
-            "segmentDetails": segment_details
         })
     except Exception as e:
-        app.logger.error(f"Segmentation failed: {str(e)}")
-        return jsonify({"error": "Segmentation failed"}), 500
+        logger.error(f"Segment lookup failed: {str(e)}")
+        return jsonify({"error": "Segment lookup failed"}), 500
 
-@app.route("/api/model", methods=["GET"])
-def get_global_model():
-    if not fl_model.global_model:
-        return jsonify({"error": "Model not initialized"}), 404
-    return jsonify({
-        "coef": fl_model.global_model.coef_.tolist(),
-        "intercept": fl_model.global_model.intercept_,
+@api.route("/api/federation/status", methods=["GET"])
+def get_federation_status():
+    return jsonify(aggregation_worker.metrics())
+
+@api.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Counters, gauges and stage timing histograms in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@api.route("/api/metrics/profile", methods=["GET"])
+def get_profile():
+    """
+    Stacks sampled since startup (or the last ?reset=1) in the folded format,
+    e.g. for flamegraph.pl. Only available with PROFILER_ENABLED set.
+    """
+    if profiler is None:
+        return jsonify({"error": "Profiler is disabled"}), 404
+    body = profiler.folded(limit=request.args.get("limit", type=int))
+    if request.args.get("reset"):
+        profiler.reset()
+    return Response(body, mimetype="text/plain")
+
+def build_model_response() -> tuple:
+    if fl_model.coef is None:
+        return {"error": "Model not initialized"}, 404
+    return {
+        "coef": fl_model.coef.tolist(),
+        "intercept": fl_model.intercept,
         "version": fl_model.model_version,
+    }, 200
+
+@api.route("/api/model/update", methods=["POST"])
+def submit_model_update():
+    """
+    Accept a locally trained update in the compact binary format described in
+    model_updates.py: the client's change to the global model, quantized and
+    optionally top-k sparse. It is queued in the user store as sent; the
+    aggregation worker of the process holding the model lock publishes a new
+    global model once enough updates are pending.
+    """
+    limit = max_payload_size(fl_model.input_dim)
+    # Refuse oversized bodies before reading them; the read is bounded too,
+    # for requests without a Content-Length
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({"error": "Update too large"}), 413
+    payload = request.stream.read(limit + 1)
+    if len(payload) > limit:
+        return jsonify({"error": "Update too large"}), 413
+    try:
+        update = decode_update(payload)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid update: {e}"}), 400
+    if update.dim != fl_model.input_dim:
+        return jsonify({"error": f"Expected dimension {fl_model.input_dim}, got {update.dim}"}), 400
+    pending = fl_model.add_encoded_update(payload)
+    return jsonify({
+        "status": "accepted",
+        "nnz": update.nnz,
+        "pending_updates": pending,
+        "model_version": fl_model.model_version,
     })
 
+def parse_model_etag(tag: str):
+    """Return the snapshot tag named by a <tag> or <tag>-p<base tag> ETag."""
+    return tag.split("-p", 1)[0] or None
+
+@api.route("/api/model", methods=["GET"])
+def get_global_model():
+    """
+    JSON by default. Clients accepting application/octet-stream get the binary
+    format from model_registry.py: a full float32 snapshot, or a patch when
+    they name the snapshot they hold with ?base=<tag> or with the ETag of
+    their copy in If-None-Match. Holding the current snapshot yields a 304.
+    Snapshots are named by tags derived from the shared version and the
+    content, so every worker answers for the same snapshot in the same way.
+    """
+    fl_model.sync()
+    if request.accept_mimetypes.best_match(["application/json", MODEL_BINARY_MIMETYPE]) != MODEL_BINARY_MIMETYPE:
+        response = cached_response("model", build_model_response)
+        # Shared caches must not serve this body to binary clients
+        response.headers["Vary"] = "Accept"
+        return response
+
+    snapshot = fl_model.history.latest()
+    if snapshot is None:
+        return jsonify({"error": "Model not initialized"}), 404
+    held = {parse_model_etag(tag) for tag in request.if_none_match.as_set()}
+    base = request.args.get("base") or None
+    if base is None:
+        known = [fl_model.history.get(tag) for tag in held if tag]
+        base = max((s for s in known if s is not None), key=lambda s: s.version, default=None)
+        base = base.tag if base is not None else None
+
+    if base == snapshot.tag or snapshot.tag in held:
+        response = Response(status=304)
+        response.set_etag(snapshot.tag)
+    else:
+        payload = fl_model.history.patch_payload(base, snapshot) if base else None
+        if payload is not None:
+            response = Response(payload, mimetype=MODEL_BINARY_MIMETYPE)
+            response.set_etag(f"{snapshot.tag}-p{base}")
+        else:
+            response = Response(fl_model.history.full_payload(snapshot), mimetype=MODEL_BINARY_MIMETYPE)
+            response.set_etag(snapshot.tag)
+    response.headers["X-Model-Version"] = str(snapshot.version)
+    response.headers["Vary"] = "Accept"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 def process_user_data(prefs: dict) -> dict:
+    """
+    Validate one prefs object and return the record to store. Raises
+    ValueError for input the store or the segmentation engine cannot take
+    (non-finite budgets, interests that are not strings), so it is rejected
+    before anything is written.
+    """
     # Store the average budget and the list of interests as given (do not sum interests)
-    budget = (float(prefs["budget"][0]) + float(prefs["budget"][1])) / 2
-    interests = prefs.get("interests", [])
+    try:
+        budget = (float(prefs["budget"][0]) + float(prefs["budget"][1])) / 2
+        interests = prefs.get("interests", [])
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        raise ValueError("Invalid data format") from e
+    if not math.isfinite(budget):
+        raise ValueError("Budget must be finite")
+    if not isinstance(interests, list) or not all(isinstance(name, str) for name in interests):
+        raise ValueError("Interests must be a list of strings")
     return {"budget": budget, "interests": interests}
 
-def process_federated_update(user_id: str, encrypted_data: bytes) -> bool:
-    try:
-        data = decrypt_data(encrypted_data)
-        # For clustering, we still need numeric features.
-        # Here we use budget and the number of interests selected.
-        features = np.array([data["budget"], len(data["interests"])])
+def fit_client_update(data: dict) -> tuple:
+    from sklearn.linear_model import LinearRegression
+    # For clustering, we still need numeric features.
+    # Here we use budget and the number of interests selected.
+    features = np.array([data["budget"], len(data["interests"])])
+    with stage_seconds.time(operation="process_federated_update", stage="fit"):
         client_model = LinearRegression()
-        X = np.random.rand(10, 2)
+        X = np.random.rand(10, fl_model.input_dim)
         y = np.random.rand(10)
         client_model.fit(X, y)
-        fl_model.client_updates.append({
-            "coef": client_model.coef_,
-            "intercept": client_model.intercept_,
-            "user_id": user_id,
-        })
-        if len(fl_model.client_updates) >= MIN_CLIENTS_FOR_AGGREGATION:
-            fl_model.aggregate_updates()
-            fl_model.model_version = f"{MODEL_VERSION}.{len(fl_model.client_updates)}"
-            return True
-        return False
-    except Exception as e:
-        app.logger.error(f"Federated update failed: {str(e)}")
-        return False
+    return client_model.coef_, client_model.intercept_
+
+def process_federated_update(user_id: str, data: dict) -> bool:
+    """
+    Queue a client update for the background aggregation worker. Returns
+    False when the queue is full and the update was dropped.
+    """
+    with stage_seconds.time(operation="process_federated_update", stage="enqueue"):
+        queued = aggregation_worker.submit(data)
+    federation_submissions.inc(result="queued" if queued else "dropped")
+    return queued
+
+aggregation_worker = AggregationWorker(
+    fl_model,
+    fit_client_update,
+    min_clients=MIN_CLIENTS_FOR_AGGREGATION,
+    window_seconds=AGGREGATION_WINDOW_SECONDS,
+    max_queue=AGGREGATION_QUEUE_SIZE,
+)
+
+# Gauges and counters kept by other components, read at scrape time
+for key, kind, documentation in (
+    ("queue_depth", "gauge", "Client updates waiting to be fitted"),
+    ("queue_capacity", "gauge", "Capacity of the aggregation queue"),
+    ("queue_high_water", "gauge", "Largest aggregation queue depth seen"),
+    ("pending_updates", "gauge", "Fitted client updates not yet aggregated"),
+    ("processed", "counter", "Client updates fitted"),
+    ("failed", "counter", "Client updates that failed to fit"),
+    ("dropped", "counter", "Client updates dropped because the queue was full"),
+    ("aggregations", "counter", "Global model aggregation rounds"),
+    ("fit_seconds_total", "counter", "Time spent fitting client updates"),
+):
+    name = key if kind == "gauge" or key.endswith("_total") else key + "_total"
+    metrics.callback(f"dataprivacy_aggregation_{name}", documentation,
+                     lambda key=key: aggregation_worker.metrics()[key], kind)
+metrics.callback("dataprivacy_model_version", "Version of the published global model",
+                 lambda: fl_model.model_version)
+metrics.callback("dataprivacy_store_users", "Records in the user store", lambda: user_store.count())
+metrics.callback("dataprivacy_store_bytes", "Approximate size of the user store", lambda: user_store.size_bytes())
+metrics.callback("dataprivacy_store_synced_seq", "Last store sequence number applied by this process",
+                 lambda: store_seq)
+metrics.callback("dataprivacy_segmentation_users", "Users held by the segmentation engine",
+                 lambda: len(segmentation))
+metrics.callback("dataprivacy_segmentation_refits_total", "Full KMeans refits",
+                 lambda: segmentation.refits, "counter")
+metrics.callback("dataprivacy_segmentation_refit_seconds_total", "Time spent in full KMeans refits",
+                 lambda: segmentation.refit_seconds, "counter")
+metrics.callback("dataprivacy_response_cache_requests_total", "Cached response lookups by outcome",
+                 lambda: {("hit",): response_cache.hits, ("miss",): response_cache.misses},
+                 "counter", ["result"])
+if profiler is not None:
+    metrics.callback("dataprivacy_profiler_samples_total", "Stack samples taken by the profiler",
+                     lambda: profiler.samples, "counter")
+
+def register_job_metrics(job: SegmentationJob):
+    """Export the background refit job's metrics; only called when the job is enabled."""
+    metrics.callback("dataprivacy_segmentation_job_runs_total", "Background segmentation refits by outcome",
+                     lambda: {(outcome,): job.metrics()[outcome]
+                              for outcome in ("published", "discarded", "adopted", "failed")},
+                     "counter", ["outcome"])
+    metrics.callback("dataprivacy_segmentation_job_owner", "Whether this process runs the shared refit job",
+                     lambda: int(job.owner))
+    metrics.callback("dataprivacy_segmentation_job_last_seconds", "Stage durations of the last background refit",
+                     lambda: {(stage,): seconds for stage, seconds in job.last_timings.items()},
+                     labelnames=["stage"])
+    metrics.callback("dataprivacy_segmentation_job_last_iterations", "k-means iterations of the last background refit",
+                     lambda: job.last_iterations)
 
 def encrypt_data(data: dict) -> bytes:
-    return cipher.encrypt(json.dumps(data).encode())
+    return codec.encode(data)
 
 def decrypt_data(encrypted_data: bytes) -> dict:
-    return json.loads(cipher.decrypt(encrypted_data).decode())
+    return codec.decode(encrypted_data)
+
+def map_in_pool(func, items: list) -> list:
+    """Apply func to every item, split into one slice per encryption worker."""
+    if len(items) < 2 * ENCRYPTION_WORKERS:
+        return [func(item) for item in items]
+    step = -(-len(items) // ENCRYPTION_WORKERS)
+    slices = [items[i:i + step] for i in range(0, len(items), step)]
+    results = []
+    for part in get_encryption_pool().map(lambda part: [func(item) for item in part], slices):
+        results.extend(part)
+    return results
+
+def encrypt_many(records: list) -> list:
+    return map_in_pool(encrypt_data, records)
+
+def encrypt_columns(budgets, masks) -> list:
+    """Encrypt binary-format records from budget and mask columns in parallel."""
+    if len(budgets) < 2 * ENCRYPTION_WORKERS:
+        return codec.encode_columns(budgets, masks)
+    step = -(-len(budgets) // ENCRYPTION_WORKERS)
+    parts = get_encryption_pool().map(
+        lambda start: codec.encode_columns(budgets[start:start + step], masks[start:start + step]),
+        range(0, len(budgets), step))
+    return [blob for part in parts for blob in part]
+
+def decode_records(encrypted_records: list) -> tuple:
+    """
+    Decrypt a batch of stored records in parallel with RecordCodec.decode_many.
+    Returns (binary_indices, budgets, masks, others, failed) over the whole batch.
+    """
+    if len(encrypted_records) < 2 * ENCRYPTION_WORKERS:
+        return codec.decode_many(encrypted_records)
+    step = -(-len(encrypted_records) // ENCRYPTION_WORKERS)
+    starts = range(0, len(encrypted_records), step)
+    parts = get_encryption_pool().map(lambda start: codec.decode_many(encrypted_records[start:start + step]), starts)
+    indices, budgets, masks, others, failed = [], [], [], [], []
+    for start, (part_indices, part_budgets, part_masks, part_others, part_failed) in zip(starts, parts):
+        indices.append(part_indices + start)
+        budgets.append(part_budgets)
+        masks.append(part_masks)
+        others.extend((index + start, record) for index, record in part_others)
+        failed.extend(index + start for index in part_failed)
+    return np.concatenate(indices), np.concatenate(budgets), np.concatenate(masks), others, failed
+
+def ingest_columns(raw_user_ids: list, budgets, masks) -> int:
+    """
+    Bulk path for generated or imported data: store and cache users given as
+    budget and interest-mask columns (over codec.interests), without building
+    per-record dicts or queueing federated updates. Returns the number stored.
+    """
+    if not len(raw_user_ids):
+        return 0
+    budgets = np.asarray(budgets, dtype=np.float64)
+    masks = np.asarray(masks, dtype=np.int64)
+    user_ids = anonymize_user_ids(raw_user_ids)
+    encrypted = encrypt_columns(budgets, masks)
+    first, last = user_store.put_many(zip(user_ids, encrypted))
+    segmentation.load_columns(user_ids, budgets, masks)
+    # load_columns leaves labels and stats to be recomputed in one pass, as
+    # in the bulk branch of sync_user_store
+    segmentation.reassign()
+    mark_synced(first, last)
+    data_generation.bump()
+    return len(user_ids)
+
+def mark_synced(first: int, last: int):
+    """Skip our own writes on the next sync, unless another worker wrote in between."""
+    global store_seq
+    with store_lock:
+        if first == store_seq + 1:
+            store_seq = last
+
+def sync_user_store() -> int:
+    """
+    Bring the in-memory segmentation caches up to date with the shared store:
+    everything on startup, then only records written since the last sync
+    (e.g. by other gunicorn workers). Returns the number of records applied.
+    """
+    global store_seq
+    with store_lock:
+        latest = user_store.latest_seq()
+        if latest <= store_seq:
+            return 0
+        # On startup and for large catch-ups (e.g. after a bulk load by
+        # synthetic_data.py) rows are loaded as arrays; labels and stats are
+        # then recomputed in one pass instead of one upsert per user.
+        bulk = store_seq == 0 or latest - store_seq > STORE_BULK_SYNC_ROWS
+        applied = 0
+        batches = user_store.scan(since=store_seq, batch_size=STORE_SCAN_BATCH)
+        while True:
+            with stage_seconds.time(operation="sync_user_store", stage="scan"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            batch_ids = [user_id for user_id, _, _ in batch]
+            with stage_seconds.time(operation="sync_user_store", stage="decrypt"):
+                indices, budgets, masks, others, failed = decode_records([record for _, record, _ in batch])
+            for index in failed:
+                logger.error(f"Could not decrypt stored record for {batch_ids[index]}")
+            # Records with non-finite budgets predate input validation; they
+            # would break the stats and every refit, so they are skipped
+            finite = np.isfinite(budgets)
+            others = [(index, record) for index, record in others if math.isfinite(record["budget"])]
+            if not finite.all():
+                logger.error(f"Skipping {int((~finite).sum())} stored records with non-finite budgets")
+                indices, budgets, masks = indices[finite], budgets[finite], masks[finite]
+            user_ids = [batch_ids[index] for index in indices]
+            other_ids = [batch_ids[index] for index, _ in others]
+            other_budgets = [record["budget"] for _, record in others]
+            other_interests = [record["interests"] for _, record in others]
+            with stage_seconds.time(operation="sync_user_store", stage="apply"):
+                if bulk:
+                    segmentation.load_columns(user_ids, budgets, masks)
+                    segmentation.load(other_ids, other_budgets, other_interests)
+                else:
+                    interests = [codec.interests_from_mask(mask) for mask in masks.tolist()]
+                    segmentation.upsert_many(user_ids + other_ids, budgets.tolist() + other_budgets,
+                                             interests + other_interests)
+            applied += len(user_ids) + len(other_ids)
+            store_seq = batch[-1][2]
+        if bulk and applied:
+            with stage_seconds.time(operation="sync_user_store", stage="reassign"):
+                segmentation.reassign()
+        if applied:
+            data_generation.bump()
+        return applied
+
+# Startup
+# Seconds spent in each startup phase of this process, logged and exported
+startup_timings = {}
+_state_ready = False
+_state_lock = threading.Lock()
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+def init_state():
+    """
+    Build the process state: keyring, store, segmentation caches warmed from
+    the store, and the global model. Runs once; under gunicorn --preload it
+    runs in the master so workers inherit the warm state copy-on-write.
+    """
+    global codec, user_store, segmentation, segmentation_job, _state_ready
+    with _state_lock:
+        if _state_ready:
+            return
+        started = time.perf_counter()
+        with startup_phase("keyring"):
+            codec = RecordCodec(Keyring.load(KEYRING_FILE), legacy_key=load_key())
+        with startup_phase("store"):
+            user_store = open_user_store(USER_STORE_PATH)
+        with startup_phase("segmentation"):
+            segmentation = SegmentationEngine(
+                n_clusters=SEGMENT_COUNT,
+                refit_interval=SEGMENT_REFIT_INTERVAL,
+                drift_threshold=SEGMENT_DRIFT_THRESHOLD,
+                interests=codec.interests,
+            )
+            if SEGMENT_JOB_INTERVAL > 0:
+                # Full refits, including the first, run in a background job
+                # over sharded worker processes, in whichever worker holds the
+                # store's job lock; the others adopt its centroids. Reads
+                # never refit inline.
+                segmentation.background_refit = True
+                segmentation_job = SegmentationJob(
+                    segmentation,
+                    ShardedKMeans(SEGMENT_COUNT, workers=SEGMENT_REFIT_WORKERS,
+                                  min_shard_rows=SEGMENT_MIN_SHARD_ROWS),
+                    interval=SEGMENT_JOB_INTERVAL,
+                    on_publish=data_generation.bump,
+                    store=user_store,
+                    sync=sync_user_store,
+                )
+                register_job_metrics(segmentation_job)
+        with startup_phase("model"):
+            fl_model.initialize_global_model(input_dim=MODEL_INPUT_DIM, store=user_store)
+        # Warm the in-memory caches from records persisted before this process started
+        with startup_phase("sync"):
+            sync_user_store()
+        startup_timings["init_total"] = time.perf_counter() - started
+        _state_ready = True
+    logger.info("Startup phases: " + ", ".join(f"{phase} {seconds * 1000:.1f}ms"
+                                               for phase, seconds in startup_timings.items()))
+
+def start_background_workers():
+    """
+    Start this process's background threads. Called on every request and a
+    no-op after the first, so each forked worker starts its own threads.
+    """
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        with startup_phase("worker_start"):
+            aggregation_worker.start()
+            if segmentation_job is not None:
+                segmentation_job.start()
+            if profiler is not None:
+                profiler.start()
+        _workers_pid = os.getpid()
+
+def create_app() -> Flask:
+    """
+    Application factory, e.g. `gunicorn --preload "app:create_app()"`.
+    """
+    app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
+    CORS(app)
+    app.logger.setLevel(logging.INFO)
+    init_state()
+    app.register_blueprint(api)
+    return app
+
+metrics.callback("dataprivacy_startup_seconds", "Duration of each startup phase in this process",
+                 lambda: {(phase,): seconds for phase, seconds in startup_timings.items()},
+                 labelnames=["phase"])
+startup_timings["import"] = time.perf_counter() - _import_started
 
 if __name__ == "__main__":
-    fl_model.initialize_global_model(input_dim=2)
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    create_app().run(host="0.0.0.0", port=5001, debug=True)
@@ -0,0 +1,183 @@
+"""
+Microbenchmarks for the backend hot paths at several user-base sizes.
+
+Runs in-process against an in-memory store and a throwaway keyring, and
+writes the results as JSON so runs from different releases can be compared:
+
+    python benchmarks.py --sizes 1000,100000,1000000 --output bench.json
+    python benchmarks.py --sizes 1000,100000 --compare bench.json --tolerance 0.25
+
+With --compare, the exit status is 1 if any benchmark's per-operation time
+regressed by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+
+# Configure the app for an isolated in-process run before importing it
+os.environ.setdefault("USER_STORE_PATH", ":memory:")
+os.environ.setdefault("KEYRING_FILE", os.path.join(tempfile.mkdtemp(), "keyring.json"))
+
+import app as backend  # noqa: E402
+from segmentation import SegmentationEngine  # noqa: E402
+from user_store import MemoryUserStore  # noqa: E402
+from aggregation import AggregationWorker  # noqa: E402
+from synthetic_data import generate_population  # noqa: E402
+from sharded_segmentation import ShardedKMeans  # noqa: E402
+
+
+def timed(func, ops, repeat=3):
+    """Best-of-`repeat` wall time for `func`, which performs `ops` operations."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return {"ops": ops, "seconds": best, "per_op_us": best / ops * 1e6, "ops_per_sec": ops / best}
+
+
+def make_prefs(chunks):
+    return [record["prefs"] for chunk in chunks for record in chunk.records()]
+
+
+def reset_state():
+    backend.segmentation = SegmentationEngine(
+        n_clusters=backend.SEGMENT_COUNT,
+        refit_interval=backend.SEGMENT_REFIT_INTERVAL,
+        drift_threshold=backend.SEGMENT_DRIFT_THRESHOLD,
+        interests=backend.codec.interests,
+    )
+    backend.user_store = MemoryUserStore()
+    backend.store_seq = 0
+    backend.response_cache.clear()
+    backend.fl_model.initialize_global_model(input_dim=2, store=backend.user_store)
+
+
+def run_size(flask_app, kmeans, size, max_ops, seed=42):
+    results = {}
+    chunks = list(generate_population(size, seed=seed))
+    prefs = make_prefs(chunks)
+    per_record = prefs[:max_ops]
+
+    results["process_user_data"] = timed(lambda: [backend.process_user_data(p) for p in per_record], len(per_record))
+    records = [backend.process_user_data(p) for p in prefs]
+    sample = records[:max_ops]
+    results["encrypt_data"] = timed(lambda: [backend.encrypt_data(r) for r in sample], len(sample))
+    blobs = backend.encrypt_many(records)
+    sample_blobs = blobs[:max_ops]
+    results["decrypt_data"] = timed(lambda: [backend.decrypt_data(b) for b in sample_blobs], len(sample_blobs))
+    results["encrypt_many"] = timed(lambda: backend.encrypt_many(records), size, repeat=1)
+    results["decode_records"] = timed(lambda: backend.decode_records(blobs), size, repeat=1)
+
+    # Federated updates: the request-path enqueue and the worker-side fit
+    fit_ops = min(size, max(1, max_ops // 50))
+    queue_worker = AggregationWorker(backend.fl_model, backend.fit_client_update, max_queue=fit_ops * 3)
+    submit = backend.aggregation_worker.submit
+    try:
+        backend.aggregation_worker.submit = queue_worker.submit
+        results["process_federated_update"] = timed(
+            lambda: [backend.process_federated_update("bench", r) for r in records[:fit_ops]], fit_ops)
+    finally:
+        backend.aggregation_worker.submit = submit
+    results["fit_client_update"] = timed(
+        lambda: [backend.fl_model.add_update(*backend.fit_client_update(r)) for r in records[:fit_ops]], fit_ops)
+
+    # Bulk load of generated columns into the store and segmentation caches
+    reset_state()
+    results["ingest_columns"] = timed(
+        lambda: [backend.ingest_columns(chunk.user_ids, chunk.budgets, chunk.masks) for chunk in chunks],
+        size, repeat=1)
+
+    # Segmentation and the /api/segments read path at this user-base size
+    reset_state()
+    user_ids = [f"{i:064x}" for i in range(size)]
+    backend.user_store.put_many(zip(user_ids, blobs))
+
+    def warm():
+        backend.store_seq = 0
+        backend.sync_user_store()
+    results["warm_from_store"] = timed(warm, size, repeat=1)
+    results["segmentation_refit"] = timed(backend.segmentation.refit, size, repeat=1)
+    X, budgets, masks, interests, _ = backend.segmentation.fit_snapshot()
+    results["sharded_refit"] = timed(lambda: kmeans.fit(X, budgets, masks, interests), size, repeat=1)
+    results["segmentation_upsert"] = timed(
+        lambda: [backend.segmentation.upsert(uid, r["budget"], r["interests"])
+                 for uid, r in zip(user_ids[:max_ops], sample)], len(sample))
+    backend.segmentation.refit()
+
+    client = flask_app.test_client()
+
+    def uncached():
+        backend.data_generation.bump()
+        client.get("/api/segments")
+    results["get_segments_uncached"] = timed(lambda: [uncached() for _ in range(20)], 20)
+    results["get_segments_cached"] = timed(lambda: [client.get("/api/segments") for _ in range(200)], 200)
+    etag = client.get("/api/segments").headers["ETag"]
+    results["get_segments_not_modified"] = timed(
+        lambda: [client.get("/api/segments", headers={"If-None-Match": etag}) for _ in range(200)], 200)
+    return results
+
+
+def compare(current, baseline, tolerance):
+    regressions = []
+    for size, benches in current["results"].items():
+        for name, result in benches.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if previous and result["per_op_us"] > previous["per_op_us"] * (1 + tolerance):
+                regressions.append((size, name, previous["per_op_us"], result["per_op_us"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--max-ops", type=int, default=20000, help="cap on per-record operations timed")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="baseline results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    flask_app = backend.create_app()
+    # Keep the aggregation worker from competing with the timed code
+    backend.start_background_workers()
+    backend.aggregation_worker.stop()
+    if backend.segmentation_job is not None:
+        backend.segmentation_job.stop()
+    kmeans = ShardedKMeans(backend.SEGMENT_COUNT, workers=backend.SEGMENT_REFIT_WORKERS,
+                           min_shard_rows=backend.SEGMENT_MIN_SHARD_ROWS)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": {},
+    }
+    for size in (int(s) for s in args.sizes.split(",")):
+        print(f"Running benchmarks with {size} users...")
+        report["results"][str(size)] = results = run_size(flask_app, kmeans, size, args.max_ops)
+        for name, result in results.items():
+            print(f"  {name:<28} {result['per_op_us']:12.2f} us/op {result['ops_per_sec']:14.1f} ops/s")
+
+    kmeans.close()
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for size, name, before, after in regressions:
+            print(f"REGRESSION {name} @ {size} users: {before:.2f} -> {after:.2f} us/op")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Versioned encryption codec for stored user records.
+
+Current records (format version 2) are laid out as
+
+    version (u8) | payload format (u8) | key id (u16 LE) | nonce (12) | AES-GCM ciphertext + tag
+
+where the 4-byte header is authenticated as associated data. The payload is
+either a fixed binary struct (budget as float64, interests as a bitmask
+against the interest vocabulary) or, for records the struct cannot
+represent, JSON. Records written before this format are raw Fernet tokens,
+which always start with 0x80 and are still readable with the legacy key.
+"""
+import os
+import json
+import time
+import base64
+import struct
+import numpy as np
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+FORMAT_VERSION = 2
+FERNET_VERSION = 0x80
+
+PAYLOAD_BINARY = 1
+PAYLOAD_JSON = 2
+
+HEADER = struct.Struct("<BBH")
+NONCE_SIZE = 12
+BINARY_PAYLOAD = struct.Struct("<dI")
+BINARY_DTYPE = np.dtype([("budget", "<f8"), ("mask", "<u4")])
+
+# Bit positions of the binary payload's interest mask. This is part of the
+# on-disk format: only ever append to it.
+INTEREST_VOCABULARY = ("tech", "finance", "sports", "health", "education")
+
+
+class Keyring:
+    """
+    AES-GCM keys by numeric id, persisted as JSON. New records are always
+    encrypted with the active key; older keys stay available for decryption
+    until every record has been rotated off them.
+    """
+
+    def __init__(self, path, keys=None, active=None):
+        self.path = path
+        self.keys = keys or {}
+        self.active = active
+        self._mtime = os.path.getmtime(path) if os.path.exists(path) else None
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            keyring = cls(path)
+            keyring.add_key()
+            keyring.save()
+            return keyring
+        with open(path) as f:
+            data = json.load(f)
+        keys = {int(key_id): base64.b64decode(key) for key_id, key in data["keys"].items()}
+        return cls(path, keys, data["active"])
+
+    def refresh(self) -> bool:
+        """Reload the keyring if the file changed on disk, e.g. after a rotation."""
+        if not os.path.exists(self.path) or os.path.getmtime(self.path) == self._mtime:
+            return False
+        fresh = Keyring.load(self.path)
+        self.keys, self.active, self._mtime = fresh.keys, fresh.active, fresh._mtime
+        return True
+
+    def save(self):
+        data = {
+            "active": self.active,
+            "keys": {str(key_id): base64.b64encode(key).decode() for key_id, key in self.keys.items()},
+        }
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+
+    def add_key(self) -> int:
+        """Generate a new key and make it the active one."""
+        key_id = max(self.keys, default=0) + 1
+        self.keys[key_id] = AESGCM.generate_key(bit_length=256)
+        self.active = key_id
+        return key_id
+
+
+class RecordCodec:
+    # How often encode() checks whether the keyring was rotated on disk
+    KEYRING_REFRESH_SECONDS = 5.0
+
+    def __init__(self, keyring, interests=INTEREST_VOCABULARY, legacy_key=None):
+        self.keyring = keyring
+        self.interests = list(interests)
+        self._interest_bits = {name: bit for bit, name in enumerate(self.interests)}
+        self._ciphers = {key_id: AESGCM(key) for key_id, key in keyring.keys.items()}
+        self._legacy = Fernet(legacy_key) if legacy_key else None
+        self._last_refresh = time.monotonic()
+
+    def _refresh_keys(self):
+        self._last_refresh = time.monotonic()
+        if self.keyring.refresh():
+            self._ciphers = {key_id: AESGCM(key) for key_id, key in self.keyring.keys.items()}
+
+    def _cipher(self, key_id):
+        cipher = self._ciphers.get(key_id)
+        if cipher is None:
+            # Written by a process that already picked up a rotated key
+            self._refresh_keys()
+            cipher = self._ciphers.get(key_id)
+        if cipher is None:
+            raise ValueError(f"Unknown key id {key_id}")
+        return cipher
+
+    def _pack(self, record):
+        interests = record.get("interests", [])
+        bits = [self._interest_bits.get(name) for name in interests]
+        # The bitmask only represents distinct, known interests
+        if None in bits or len(set(bits)) != len(bits) or len(self.interests) > 32:
+            return PAYLOAD_JSON, json.dumps(record).encode()
+        mask = 0
+        for bit in bits:
+            mask |= 1 << bit
+        return PAYLOAD_BINARY, BINARY_PAYLOAD.pack(float(record["budget"]), mask)
+
+    def interests_from_mask(self, mask):
+        return [name for bit, name in enumerate(self.interests) if mask >> bit & 1]
+
+    def encode(self, record: dict) -> bytes:
+        if time.monotonic() - self._last_refresh >= self.KEYRING_REFRESH_SECONDS:
+            self._refresh_keys()
+        payload_format, payload = self._pack(record)
+        header = HEADER.pack(FORMAT_VERSION, payload_format, self.keyring.active)
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + self._cipher(self.keyring.active).encrypt(nonce, payload, header)
+
+    def encode_columns(self, budgets, masks) -> list:
+        """
+        Encode binary-format records straight from budget and mask columns,
+        e.g. for bulk loads. Masks must use this codec's interest vocabulary.
+        """
+        if time.monotonic() - self._last_refresh >= self.KEYRING_REFRESH_SECONDS:
+            self._refresh_keys()
+        columns = np.empty(len(budgets), dtype=BINARY_DTYPE)
+        columns["budget"] = budgets
+        columns["mask"] = masks
+        payloads = columns.tobytes()
+        size = BINARY_DTYPE.itemsize
+        header = HEADER.pack(FORMAT_VERSION, PAYLOAD_BINARY, self.keyring.active)
+        encrypt = self._cipher(self.keyring.active).encrypt
+        blobs = []
+        for offset in range(0, len(payloads), size):
+            nonce = os.urandom(NONCE_SIZE)
+            blobs.append(header + nonce + encrypt(nonce, payloads[offset:offset + size], header))
+        return blobs
+
+    def _decrypt(self, blob):
+        """Return (payload format, plaintext) for a version 2 record."""
+        version, payload_format, key_id = HEADER.unpack_from(blob)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported record version {version}")
+        header = blob[:HEADER.size]
+        nonce = blob[HEADER.size:HEADER.size + NONCE_SIZE]
+        plaintext = self._cipher(key_id).decrypt(nonce, blob[HEADER.size + NONCE_SIZE:], header)
+        return payload_format, plaintext
+
+    def decode(self, blob: bytes) -> dict:
+        if blob[0] == FERNET_VERSION:
+            if self._legacy is None:
+                raise ValueError("Legacy record but no legacy key configured")
+            return json.loads(self._legacy.decrypt(base64.urlsafe_b64encode(blob)).decode())
+        payload_format, plaintext = self._decrypt(blob)
+        if payload_format == PAYLOAD_BINARY:
+            budget, mask = BINARY_PAYLOAD.unpack(plaintext)
+            return {"budget": budget, "interests": self.interests_from_mask(mask)}
+        return json.loads(plaintext.decode())
+
+    def decode_many(self, blobs):
+        """
+        Decode a batch of records. Binary-format records are parsed with a
+        single np.frombuffer over their concatenated plaintexts and returned as
+        columns; anything else (JSON payloads, legacy Fernet tokens) comes back
+        as dicts. Records that fail to decrypt are reported by index.
+
+        Returns (binary_indices, budgets, masks, others, failed) where `others`
+        is a list of (index, record) pairs.
+        """
+        binary_indices, plaintexts, others, failed = [], [], [], []
+        for index, blob in enumerate(blobs):
+            try:
+                if blob[0] == FORMAT_VERSION:
+                    payload_format, plaintext = self._decrypt(blob)
+                    if payload_format == PAYLOAD_BINARY:
+                        binary_indices.append(index)
+                        plaintexts.append(plaintext)
+                        continue
+                    others.append((index, json.loads(plaintext.decode())))
+                else:
+                    others.append((index, self.decode(blob)))
+            except Exception:
+                failed.append(index)
+        columns = np.frombuffer(b"".join(plaintexts), dtype=BINARY_DTYPE)
+        return (np.array(binary_indices, dtype=np.int64), columns["budget"].astype(np.float64),
+                columns["mask"].astype(np.int64), others, failed)
+
+    def needs_rotation(self, blob: bytes) -> bool:
+        """True if the record is not in the current format under the active key."""
+        if blob[0] != FORMAT_VERSION:
+            return True
+        return HEADER.unpack_from(blob)[2] != self.keyring.active
+
+    def reencrypt(self, blob: bytes) -> bytes:
+        return self.encode(self.decode(blob))
@@ -0,0 +1,279 @@
+"""
+Concurrent load generator for the backend API.
+
+Drives a configurable mix of /api/save-preferences, /api/segments and
+/api/model requests over keep-alive HTTP/1.1 connections, and reports
+throughput and latency percentiles per endpoint.
+
+With --rate, requests arrive open-loop as a Poisson process and queueing for
+a free connection counts towards latency, so an overloaded server shows up as
+growing tail latency rather than as a quietly lower request rate. Without it,
+--concurrency clients send requests back to back (closed loop).
+
+    python loadgen.py --url https://localhost:5000 --insecure \\
+        --concurrency 64 --rate 500 --duration 30 --mix save=0.2,segments=0.7,model=0.1
+"""
+import ssl
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+INTERESTS = ["tech", "finance", "sports", "health", "education"]
+
+
+class HTTPConnection:
+    """Minimal keep-alive HTTP/1.1 client connection on asyncio streams."""
+
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+
+    async def request(self, method, path, headers=None, body=b""):
+        for attempt in range(2):
+            if self.writer is None:
+                await self._connect()
+            try:
+                return await self._exchange(method, path, headers or {}, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed an idle keep-alive connection; retry once
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _exchange(self, method, path, headers, body):
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                 f"Content-Length: {len(body)}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            payload = b"".join(chunks)
+        elif "content-length" in response_headers:
+            payload = await self.reader.readexactly(int(response_headers["content-length"]))
+        elif status in (204, 304) or method == "HEAD":
+            payload = b""
+        else:
+            payload = await self.reader.read()
+            await self.close()
+            return status, payload
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, payload
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+    def record(self, latency, status):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status is None or status >= 500:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(count - 1, int(q * count))] * 1000
+
+        # Latency histogram with power-of-two millisecond buckets
+        histogram = {}
+        for latency in latencies:
+            bucket = 1
+            while bucket < latency * 1000:
+                bucket *= 2
+            histogram[f"<={bucket}ms"] = histogram.get(f"<={bucket}ms", 0) + 1
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "throughput_rps": count / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items(), key=str)},
+            "histogram": histogram,
+        }
+
+
+def random_prefs():
+    low = random.randint(100, 500)
+    return {"prefs": {
+        "budget": [low, random.randint(low + 1, 1500)],
+        "interests": random.sample(INTERESTS, random.randint(1, 3)),
+    }}
+
+
+def build_request(endpoint, user_count):
+    if endpoint == "save":
+        body = json.dumps(random_prefs()).encode()
+        headers = {"Content-Type": "application/json",
+                   "X-User-ID": f"load_user_{random.randrange(user_count)}"}
+        return "POST", "/api/save-preferences", headers, body
+    if endpoint == "segments":
+        return "GET", "/api/segments", {}, b""
+    return "GET", "/api/model", {}, b""
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("save", "segments", "model"):
+            raise ValueError(f"Unknown endpoint in mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+async def run_load(url, concurrency=16, rate=0.0, duration=10.0, mix=None, user_count=100000,
+                   insecure=False, max_requests=None):
+    parts = urlsplit(url)
+    ssl_context = None
+    if parts.scheme == "https":
+        ssl_context = ssl.create_default_context()
+        if insecure:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+
+    mix = mix or {"save": 0.5, "segments": 0.4, "model": 0.1}
+    endpoints, weights = list(mix), list(mix.values())
+    stats = {endpoint: EndpointStats() for endpoint in endpoints}
+
+    pool = asyncio.Queue()
+    for _ in range(concurrency):
+        pool.put_nowait(HTTPConnection(parts.hostname, port, ssl_context))
+
+    async def one_request(endpoint, scheduled):
+        method, path, headers, body = build_request(endpoint, user_count)
+        conn = await pool.get()
+        status = None
+        try:
+            status, _ = await conn.request(method, path, headers, body)
+        except Exception:
+            await conn.close()
+        finally:
+            pool.put_nowait(conn)
+        stats[endpoint].record(time.perf_counter() - scheduled, status)
+
+    started = time.perf_counter()
+    deadline = started + duration
+    sent = 0
+
+    def more():
+        return time.perf_counter() < deadline and (max_requests is None or sent < max_requests)
+
+    if rate > 0:
+        tasks = set()
+        next_arrival = started
+        while more():
+            next_arrival += random.expovariate(rate)
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(one_request(random.choices(endpoints, weights)[0], next_arrival))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+    else:
+        async def client():
+            nonlocal sent
+            while more():
+                sent += 1
+                await one_request(random.choices(endpoints, weights)[0], time.perf_counter())
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    elapsed = time.perf_counter() - started
+    while not pool.empty():
+        await pool.get_nowait().close()
+
+    all_stats = EndpointStats()
+    for endpoint_stats in stats.values():
+        all_stats.latencies.extend(endpoint_stats.latencies)
+        all_stats.errors += endpoint_stats.errors
+        for status, n in endpoint_stats.statuses.items():
+            all_stats.statuses[status] = all_stats.statuses.get(status, 0) + n
+    return {
+        "config": {"url": url, "concurrency": concurrency, "rate": rate, "duration": duration, "mix": mix},
+        "elapsed_seconds": elapsed,
+        "total": all_stats.summary(elapsed),
+        "endpoints": {endpoint: endpoint_stats.summary(elapsed) for endpoint, endpoint_stats in stats.items()},
+    }
+
+
+def print_report(report):
+    print(f"{'endpoint':<10} {'reqs':>8} {'err':>6} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = list(report["endpoints"].items()) + [("total", report["total"])]
+    for name, summary in rows:
+        def fmt(value):
+            return f"{value:9.2f}" if value is not None else f"{'-':>9}"
+        print(f"{name:<10} {summary['requests']:>8} {summary['errors']:>6} {summary['throughput_rps']:9.1f} "
+              f"{fmt(summary['p50_ms'])} {fmt(summary['p95_ms'])} {fmt(summary['p99_ms'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0.0, help="arrivals per second (0 = closed loop)")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    parser.add_argument("--mix", default="save=0.5,segments=0.4,model=0.1")
+    parser.add_argument("--users", type=int, default=100000, help="distinct simulated user IDs")
+    parser.add_argument("--insecure", action="store_true", help="skip TLS certificate verification")
+    parser.add_argument("--output", help="write the full report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args.url, args.concurrency, args.rate, args.duration, parse_mix(args.mix),
+                                  args.users, args.insecure, args.requests))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
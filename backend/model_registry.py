@@ -0,0 +1,153 @@
+"""
+Versioned global model snapshots and their binary distribution format.
+
+Every published model gets a version and a tag, v<version>.<digest>, where
+the digest is a hash of its float32 coefficients and intercept. Versions are
+those of the model blob in the shared user store, so every gunicorn worker
+gives the same snapshot the same tag. Clients name the snapshot they hold by
+that tag, and a worker that does not have that exact snapshot never answers
+with a 304 or a patch against it. A short history of snapshots is kept so
+clients can ask for a patch against the one they already hold instead of
+downloading the full model again.
+
+Binary payloads are little-endian:
+
+    magic         4s   b"FLM1"
+    kind          u8   0 = full snapshot, 1 = patch against base_version
+    reserved      3x
+    version       u64
+    base_version  u64  0 for full snapshots
+    dim           u32
+    count         u32  number of values that follow
+    intercept     f64
+    indices       u32[count]   patches only
+    values        f32[count]
+
+A patch carries the new float32 value of every coefficient that changed, so
+applying it to the base snapshot reproduces the new snapshot exactly.
+
+The model itself is shared between processes through the store as
+encode_model() blobs: dim (u32), intercept (f64), then the float64
+coefficients.
+"""
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+MAGIC = b"FLM1"
+HEADER = struct.Struct("<4sB3xQQIId")
+KIND_FULL = 0
+KIND_PATCH = 1
+STATE_HEADER = struct.Struct("<Id")
+
+
+def encode_model(coef, intercept) -> bytes:
+    coef = np.asarray(coef, dtype="<f8")
+    return STATE_HEADER.pack(len(coef), intercept) + coef.tobytes()
+
+
+def decode_model(payload: bytes):
+    """Returns (coef, intercept) from an encode_model() blob."""
+    dim, intercept = STATE_HEADER.unpack_from(payload)
+    return np.frombuffer(payload, dtype="<f8", count=dim, offset=STATE_HEADER.size).copy(), intercept
+
+
+class ModelSnapshot:
+    __slots__ = ("version", "coef", "intercept", "tag")
+
+    def __init__(self, version, coef, intercept):
+        self.version = version
+        self.coef = coef
+        self.intercept = intercept
+        digest = hashlib.blake2b(coef.tobytes() + struct.pack("<d", intercept), digest_size=8).hexdigest()
+        self.tag = f"v{version}.{digest}"
+
+
+class ModelHistory:
+    def __init__(self, max_versions=8, max_cached_patches=32):
+        self.max_versions = max_versions
+        self.max_cached_patches = max_cached_patches
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()
+        self._full_payloads = {}
+        self._patches = OrderedDict()
+        self._latest = None
+        self.version = 0
+
+    def publish(self, coef, intercept, version=None) -> int:
+        """
+        Store a new snapshot and return its version: `version` when given,
+        e.g. the shared version of the model blob, otherwise the next one.
+        """
+        with self._lock:
+            self.version = self.version + 1 if version is None else version
+            snapshot = ModelSnapshot(self.version, np.array(coef, dtype="<f4"), float(intercept))
+            self._snapshots[snapshot.tag] = snapshot
+            self._latest = snapshot
+            while len(self._snapshots) > self.max_versions:
+                old_tag, _ = self._snapshots.popitem(last=False)
+                self._full_payloads.pop(old_tag, None)
+            return self.version
+
+    def latest(self):
+        return self._latest
+
+    def get(self, tag):
+        """The snapshot with this tag, or None if it is not in the history."""
+        return self._snapshots.get(tag)
+
+    def full_payload(self, snapshot) -> bytes:
+        payload = self._full_payloads.get(snapshot.tag)
+        if payload is None:
+            dim = len(snapshot.coef)
+            payload = HEADER.pack(MAGIC, KIND_FULL, snapshot.version, 0, dim, dim,
+                                  snapshot.intercept) + snapshot.coef.tobytes()
+            self._full_payloads[snapshot.tag] = payload
+        return payload
+
+    def patch_payload(self, base_tag, snapshot):
+        """
+        Patch from the snapshot tagged base_tag to snapshot, or None when the
+        base is not in the history or a patch would not be smaller than the
+        full snapshot.
+        """
+        key = (base_tag, snapshot.tag)
+        with self._lock:
+            if key in self._patches:
+                self._patches.move_to_end(key)
+                return self._patches[key]
+        base = self.get(base_tag)
+        if base is None or base.version >= snapshot.version or len(base.coef) != len(snapshot.coef):
+            return None
+        changed = np.flatnonzero(base.coef != snapshot.coef).astype("<u4")
+        # Each patched value costs 8 bytes against 4 for a full snapshot
+        if 2 * len(changed) >= len(snapshot.coef):
+            payload = None
+        else:
+            payload = HEADER.pack(MAGIC, KIND_PATCH, snapshot.version, base.version,
+                                  len(snapshot.coef), len(changed), snapshot.intercept)
+            payload += changed.tobytes() + snapshot.coef[changed].tobytes()
+        with self._lock:
+            self._patches[key] = payload
+            while len(self._patches) > self.max_cached_patches:
+                self._patches.popitem(last=False)
+        return payload
+
+
+def apply_payload(payload: bytes, base_coef=None):
+    """Decode a full snapshot or patch; returns (version, coef, intercept)."""
+    magic, kind, version, _, dim, count, intercept = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("Not a model payload")
+    offset = HEADER.size
+    if kind == KIND_FULL:
+        return version, np.frombuffer(payload, dtype="<f4", count=dim, offset=offset).copy(), intercept
+    if base_coef is None:
+        raise ValueError("A patch needs the base coefficients")
+    indices = np.frombuffer(payload, dtype="<u4", count=count, offset=offset)
+    values = np.frombuffer(payload, dtype="<f4", count=count, offset=offset + 4 * count)
+    coef = np.array(base_coef, dtype="<f4")
+    coef[indices] = values
+    return version, coef, intercept
@@ -0,0 +1,139 @@
+"""
+Compact binary format for client model updates posted to /api/model/update.
+
+An update is the client's change to the current global model (its locally
+trained coefficients minus the global ones), not the coefficients themselves.
+
+All fields are little-endian:
+
+    magic      4s   b"FLU1"
+    dtype      u8   0 = float32, 1 = float16, 2 = int8
+    flags      u8   bit 0 set = sparse (indices present)
+    reserved   u16
+    dim        u32  model dimension
+    nnz        u32  number of values (equal to dim for dense updates)
+    scale      f32  dequantization scale
+    intercept  f32  change to the intercept
+    weight     f32  FedAvg weight, e.g. the client's sample count
+    indices    u32[nnz]    only when sparse, strictly increasing
+    values     dtype[nnz]
+
+The server reconstructs the change to coefficient i as
+float32(values[k]) * float32(scale) for indices[k] == i, and 0 for indices
+that are not sent. Each aggregation round moves the global model by the
+weighted mean change of its updates:
+
+    global += sum(weight * delta) / sum(weight)
+
+so a coefficient left out of a sparse update counts as unchanged by that
+client. Clients doing error feedback can compute exactly what the server received with
+`dequantize(decode_update(payload))` (or use the second value returned by
+`encode_update`) and carry the difference into their next round.
+"""
+import struct
+import numpy as np
+
+MAGIC = b"FLU1"
+HEADER = struct.Struct("<4sBBHIIfff")
+FLAG_SPARSE = 1
+
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2"), 2: np.dtype("i1")}
+DTYPE_CODES = {"float32": 0, "float16": 1, "int8": 2}
+
+
+class ModelUpdate:
+    __slots__ = ("dim", "indices", "values", "intercept", "weight")
+
+    def __init__(self, dim, indices, values, intercept, weight):
+        self.dim = dim
+        # None for dense updates
+        self.indices = indices
+        # Dequantized float32 values, one per index (or per dimension)
+        self.values = values
+        self.intercept = intercept
+        self.weight = weight
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+
+def max_payload_size(dim: int) -> int:
+    """Upper bound on a valid payload for a model of this dimension."""
+    return HEADER.size + dim * 8
+
+
+def decode_update(payload: bytes) -> ModelUpdate:
+    """Parse and validate an update; raises ValueError on malformed input."""
+    if len(payload) < HEADER.size:
+        raise ValueError("Update is shorter than its header")
+    magic, dtype_code, flags, _, dim, nnz, scale, intercept, weight = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("Not a model update")
+    dtype = DTYPES.get(dtype_code)
+    if dtype is None:
+        raise ValueError(f"Unknown value type {dtype_code}")
+    sparse = bool(flags & FLAG_SPARSE)
+    if nnz > dim or (not sparse and nnz != dim):
+        raise ValueError("Value count does not match dimension")
+    if not (np.isfinite([scale, intercept, weight]).all() and weight > 0):
+        raise ValueError("Invalid scale, intercept or weight")
+
+    offset = HEADER.size
+    indices = None
+    expected = offset + (4 * nnz if sparse else 0) + dtype.itemsize * nnz
+    if len(payload) != expected:
+        raise ValueError("Update length does not match its header")
+    if sparse:
+        indices = np.frombuffer(payload, dtype="<u4", count=nnz, offset=offset).astype(np.int64)
+        offset += 4 * nnz
+        if nnz and (indices[-1] >= dim or (nnz > 1 and np.any(np.diff(indices) <= 0))):
+            raise ValueError("Indices must be strictly increasing and below dim")
+    raw = np.frombuffer(payload, dtype=dtype, count=nnz, offset=offset)
+    with np.errstate(over="ignore", invalid="ignore"):
+        values = raw.astype(np.float32) * np.float32(scale)
+    if not np.isfinite(values).all():
+        raise ValueError("Update contains non-finite values")
+    return ModelUpdate(dim, indices, values, float(intercept), float(weight))
+
+
+def dequantize(update: ModelUpdate) -> np.ndarray:
+    """Dense float32 coefficients represented by an update."""
+    if update.indices is None:
+        return update.values.copy()
+    dense = np.zeros(update.dim, dtype=np.float32)
+    dense[update.indices] = update.values
+    return dense
+
+
+def encode_update(coef, intercept=0.0, dtype="float16", top_k=None, weight=1.0):
+    """
+    Build an update payload from a dense coefficient change. With top_k, only the k
+    largest-magnitude entries are sent. Returns (payload, sent) where `sent`
+    is the dense vector the server will reconstruct, for error feedback.
+    """
+    coef = np.asarray(coef, dtype=np.float32)
+    dim = len(coef)
+    indices = None
+    values = coef
+    if top_k is not None and top_k < dim:
+        indices = np.sort(np.argpartition(np.abs(coef), dim - top_k)[dim - top_k:]).astype("<u4")
+        values = coef[indices]
+
+    code = DTYPE_CODES[dtype]
+    scale = 1.0
+    if dtype == "int8":
+        peak = float(np.abs(values).max()) if len(values) else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        quantized = np.clip(np.rint(values / scale), -127, 127).astype("i1")
+    else:
+        quantized = values.astype(DTYPES[code])
+
+    header = HEADER.pack(MAGIC, code, FLAG_SPARSE if indices is not None else 0, 0,
+                         dim, len(quantized), scale, intercept, weight)
+    parts = [header]
+    if indices is not None:
+        parts.append(indices.tobytes())
+    parts.append(quantized.tobytes())
+    payload = b"".join(parts)
+    return payload, dequantize(decode_update(payload))
@@ -0,0 +1,77 @@
+import json
+import hashlib
+import threading
+
+
+class GenerationCounter:
+    """Monotonic counter bumped whenever data that feeds a cached response changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def bump(self) -> int:
+        with self._lock:
+            self.value += 1
+            return self.value
+
+
+class CachedResponse:
+    __slots__ = ("generation", "body", "status", "etag")
+
+    def __init__(self, generation, body, status, etag):
+        self.generation = generation
+        self.body = body
+        self.status = status
+        self.etag = etag
+
+
+class ResponseCache:
+    """
+    Pre-serialized JSON responses keyed by name and data generation.
+
+    A response is computed at most once per generation: concurrent requests
+    for a stale entry wait on a per-key lock while the first one recomputes,
+    then all of them are served the same bytes. The ETag is a hash of the
+    body, so it is a valid strong validator across workers.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key_lock(self, key):
+        with self._locks_guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def get(self, key, generation, compute) -> CachedResponse:
+        """
+        Return the cached response for `key` at `generation`, calling
+        `compute()` -> (payload, status) to rebuild it if it is stale.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.generation >= generation:
+            self.hits += 1
+            return entry
+        with self._key_lock(key):
+            # Another request may have recomputed while we waited
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation >= generation:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            payload, status = compute()
+            body = json.dumps(payload, separators=(",", ":")).encode()
+            etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+            entry = CachedResponse(generation, body, status, etag)
+            self._entries[key] = entry
+            return entry
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,94 @@
+"""
+Rotate the record encryption key and re-encrypt the user store.
+
+Adds a new key to the keyring and makes it active (running app processes
+pick it up within a few seconds), then re-encrypts every record that is not
+under the new key, including legacy Fernet records, across a process pool.
+Rerunning is safe: records already under the active key are skipped.
+
+    python rotate_keys.py --store users.db --keyring keyring.json --workers 8
+    python rotate_keys.py --store users.db --keyring keyring.json --retire
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from codec import Keyring, RecordCodec
+from user_store import open_user_store
+
+_codec = None
+
+def _init_worker(keyring_path, legacy_key_path):
+    global _codec
+    legacy_key = None
+    if legacy_key_path and os.path.exists(legacy_key_path):
+        with open(legacy_key_path, "rb") as f:
+            legacy_key = f.read()
+    _codec = RecordCodec(Keyring.load(keyring_path), legacy_key=legacy_key)
+
+def _reencrypt(rows):
+    """Re-encrypt one batch of (key, record) rows; returns (updates, failed_count)."""
+    updates, failed = [], 0
+    for row_key, record in rows:
+        if not _codec.needs_rotation(record):
+            continue
+        try:
+            updates.append((row_key, record, _codec.reencrypt(record)))
+        except Exception:
+            failed += 1
+    return updates, failed
+
+def rotate(store, keyring_path, legacy_key_path=None, workers=None, batch_size=5000):
+    keyring = Keyring.load(keyring_path)
+    key_id = keyring.add_key()
+    keyring.save()
+    print(f"Active key is now {key_id}")
+    return reencrypt_store(store, keyring_path, legacy_key_path, workers, batch_size)
+
+def reencrypt_store(store, keyring_path, legacy_key_path=None, workers=None, batch_size=5000):
+    workers = workers or os.cpu_count() or 1
+    replaced = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(keyring_path, legacy_key_path)) as pool:
+        in_flight = []
+        for rows in store.scan_records(batch_size):
+            in_flight.append(pool.submit(_reencrypt, rows))
+            # Bound the number of batches held in memory
+            if len(in_flight) >= 2 * workers:
+                updates, batch_failed = in_flight.pop(0).result()
+                replaced += store.replace_records(updates) if updates else 0
+                failed += batch_failed
+        for future in in_flight:
+            updates, batch_failed = future.result()
+            replaced += store.replace_records(updates) if updates else 0
+            failed += batch_failed
+    print(f"Re-encrypted {replaced} records ({failed} could not be decrypted)")
+    return replaced, failed
+
+def retire_keys(store, keyring_path):
+    """Drop every key except the active one, if no record still uses them."""
+    keyring = Keyring.load(keyring_path)
+    codec = RecordCodec(keyring)
+    remaining = sum(codec.needs_rotation(record) for rows in store.scan_records() for _, record in rows)
+    if remaining:
+        print(f"{remaining} records are not under the active key yet; rerun the rotation first")
+        return False
+    keyring.keys = {keyring.active: keyring.keys[keyring.active]}
+    keyring.save()
+    print(f"Retired all keys except {keyring.active}")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", default=os.getenv("USER_STORE_PATH", "users.db"))
+    parser.add_argument("--keyring", default=os.getenv("KEYRING_FILE", "keyring.json"))
+    parser.add_argument("--legacy-key", default="secret.key", help="Fernet key of pre-codec records")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--retire", action="store_true", help="remove old keys once nothing uses them")
+    args = parser.parse_args()
+
+    user_store = open_user_store(args.store)
+    if args.retire:
+        retire_keys(user_store, args.keyring)
+    else:
+        rotate(user_store, args.keyring, args.legacy_key, args.workers, args.batch_size)
@@ -0,0 +1,290 @@
+import math
+from collections import Counter
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable approximate-quantile sketch with relative-error guarantees
+    (DDSketch). Values are counted in logarithmically sized buckets, so every
+    quantile estimate is within `relative_accuracy` of the true value.
+
+    Unlike t-digest or P², bucket counts can also be decremented, which lets
+    the sketch follow users overwriting their preferences.
+    """
+
+    MIN_INDEXABLE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = Counter()
+        self.negative = Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, magnitude):
+        return int(math.ceil(math.log(magnitude) / self._log_gamma))
+
+    def _value(self, key):
+        return 2.0 * self.gamma ** key / (self.gamma + 1)
+
+    def _bucket(self, value):
+        if value > self.MIN_INDEXABLE:
+            return self.positive, self._key(value)
+        if value < -self.MIN_INDEXABLE:
+            return self.negative, self._key(-value)
+        return None, None
+
+    def add(self, value, count=1):
+        store, key = self._bucket(value)
+        if store is None:
+            self.zero_count += count
+        else:
+            store[key] += count
+        self.count += count
+
+    def remove(self, value, count=1):
+        store, key = self._bucket(value)
+        if store is None:
+            self.zero_count -= count
+        else:
+            store[key] -= count
+            if store[key] <= 0:
+                del store[key]
+        self.count -= count
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        for store, magnitudes in ((self.positive, values[values > self.MIN_INDEXABLE]),
+                                  (self.negative, -values[values < -self.MIN_INDEXABLE])):
+            if magnitudes.size:
+                keys = np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64)
+                uniq, counts = np.unique(keys, return_counts=True)
+                store.update(dict(zip(uniq.tolist(), counts.tolist())))
+        self.zero_count += int(np.count_nonzero(np.abs(values) <= self.MIN_INDEXABLE))
+        self.count += int(values.size)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _ordered_buckets(self):
+        for key in sorted(self.negative, reverse=True):
+            yield -self._value(key), self.negative[key]
+        if self.zero_count:
+            yield 0.0, self.zero_count
+        for key in sorted(self.positive):
+            yield self._value(key), self.positive[key]
+
+    def quantile(self, q):
+        if self.count <= 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self._ordered_buckets():
+            seen += count
+            if seen > rank:
+                return value
+        return value
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": dict(self.positive),
+            "negative": dict(self.negative),
+            "zero_count": self.zero_count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.positive.update({int(k): v for k, v in data["positive"].items()})
+        sketch.negative.update({int(k): v for k, v in data["negative"].items()})
+        sketch.zero_count = data["zero_count"]
+        sketch.count = sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zero_count
+        return sketch
+
+
+class RunningStats:
+    """
+    Streaming budget and interest statistics: Welford mean/variance, min/max,
+    an approximate median and interest frequencies. Supports removing a
+    previously added observation and merging with stats from another worker.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.interests = Counter()
+
+    def add(self, budget, interests=()):
+        self.count += 1
+        delta = budget - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (budget - self.mean)
+        self.min = min(self.min, budget)
+        self.max = max(self.max, budget)
+        self.sketch.add(budget)
+        self.interests.update(interests)
+
+    def remove(self, budget, interests=()):
+        if self.count <= 1:
+            self.__init__(self.sketch.relative_accuracy)
+            return
+        delta = budget - self.mean
+        self.count -= 1
+        self.mean -= delta / self.count
+        self._m2 = max(self._m2 - delta * (budget - self.mean), 0.0)
+        self.sketch.remove(budget)
+        self.interests.subtract(interests)
+        self.interests = +self.interests
+        # Exact bounds cannot be recovered after removing an extreme value;
+        # fall back to the sketch, which is within the relative accuracy.
+        if budget <= self.min:
+            self.min = self.sketch.quantile(0.0)
+        if budget >= self.max:
+            self.max = self.sketch.quantile(1.0)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self._m2 = other.count, other.mean, other._m2
+        else:
+            total = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / total
+            self._m2 += other._m2 + delta * delta * self.count * other.count / total
+            self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        self.interests.update(other.interests)
+
+    @classmethod
+    def from_arrays(cls, budgets, interests=None, relative_accuracy=0.01):
+        """Build stats for a whole column of budgets in one vectorized pass."""
+        stats = cls(relative_accuracy)
+        budgets = np.asarray(budgets, dtype=np.float64)
+        if budgets.size:
+            stats.count = int(budgets.size)
+            stats.mean = float(budgets.mean())
+            stats._m2 = float(((budgets - stats.mean) ** 2).sum())
+            stats.min = float(budgets.min())
+            stats.max = float(budgets.max())
+            stats.sketch.add_many(budgets)
+        if interests:
+            stats.interests.update(interests)
+        return stats
+
+    @property
+    def variance(self):
+        # Sample variance, matching pandas' default ddof=1
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def median(self):
+        return self.sketch.quantile(0.5) if self.count else 0.0
+
+    def common_interest(self):
+        if not self.interests:
+            return "N/A"
+        # Ties resolve to the alphabetically first interest, like Series.mode();
+        # compared as strings so non-string interest names cannot break it
+        return min(self.interests.items(), key=lambda item: (-item[1], str(item[0])))[0]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean if self.count else 0.0,
+            "median": self.median,
+            "std": math.sqrt(self.variance),
+            "min": self.min if self.count else 0.0,
+            "max": self.max if self.count else 0.0,
+            "common_interest": self.common_interest(),
+        }
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self._m2,
+            "min": self.min,
+            "max": self.max,
+            "sketch": self.sketch.to_dict(),
+            "interests": dict(self.interests),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["sketch"]["relative_accuracy"])
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats._m2 = data["m2"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        stats.sketch = QuantileSketch.from_dict(data["sketch"])
+        stats.interests.update(data["interests"])
+        return stats
+
+
+class SegmentStatistics:
+    """
+    Running stats kept globally and per segment. Interests are passed in as
+    bitmasks against `vocabulary` so a full rebuild after a refit can be done
+    with array operations.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.overall = RunningStats()
+        self.segments = {}
+
+    def names(self, mask):
+        return [name for bit, name in enumerate(self.vocabulary) if mask >> bit & 1]
+
+    def add(self, label, budget, mask):
+        interests = self.names(mask)
+        self.overall.add(budget, interests)
+        self.segments.setdefault(label, RunningStats()).add(budget, interests)
+
+    def remove(self, label, budget, mask):
+        interests = self.names(mask)
+        self.overall.remove(budget, interests)
+        segment = self.segments.get(label)
+        if segment is not None:
+            segment.remove(budget, interests)
+            if segment.count == 0:
+                del self.segments[label]
+
+    def _from_arrays(self, budgets, masks):
+        bits = np.arange(len(self.vocabulary), dtype=np.int64)
+        bit_counts = ((masks[:, None] >> bits) & 1).sum(axis=0)
+        interests = {name: int(c) for name, c in zip(self.vocabulary, bit_counts) if c}
+        return RunningStats.from_arrays(budgets, interests)
+
+    def merge(self, other):
+        """Fold in stats computed over a disjoint set of users, e.g. another shard."""
+        self.overall.merge(other.overall)
+        for label, stats in other.segments.items():
+            self.segments.setdefault(label, RunningStats()).merge(stats)
+
+    def rebuild(self, labels, budgets, masks):
+        """Recompute all stats from the full columns after labels were reassigned."""
+        self.overall = self._from_arrays(budgets, masks)
+        self.segments = {}
+        for label in np.unique(labels):
+            selected = labels == label
+            self.segments[int(label)] = self._from_arrays(budgets[selected], masks[selected])
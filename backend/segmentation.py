@@ -0,0 +1,441 @@
+import time
+import threading
+import numpy as np
+from running_stats import SegmentStatistics
+
+
+def nearest_centroids(X, centroids, squared_norms=None):
+    """
+    Return (index of the nearest centroid, squared distance to it) per row.
+    Callers iterating over the same rows can pass their precomputed |x|^2.
+    """
+    if squared_norms is None:
+        squared_norms = (X * X).sum(axis=1)
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2; |x|^2 does not affect the argmin
+    partial = (centroids * centroids).sum(axis=1) - 2 * (X @ centroids.T)
+    labels = partial.argmin(axis=1)
+    best = squared_norms + np.take_along_axis(partial, labels[:, None], axis=1)[:, 0]
+    return labels.astype(np.int32), np.maximum(best, 0.0)
+
+
+class SegmentationEngine:
+    """
+    Keeps the numeric feature matrix used for segmentation in memory and
+    maintains cluster assignments incrementally.
+
+    Each write assigns the user to the nearest centroid and nudges that
+    centroid towards the new point (online / mini-batch k-means). A full
+    KMeans refit only happens when the centroids are stale: on a schedule,
+    when the data set has grown substantially, when the global model changes,
+    or when the error of new points drifts past a threshold relative to the
+    last refit.
+
+    Budget and interest statistics are maintained alongside, globally and per
+    segment, so reads never have to touch the encrypted records.
+
+    With `background_refit` set, reads never run the full refit inline, not
+    even the first one; a background job takes a `fit_snapshot()`, fits it
+    elsewhere and installs the result with `publish()`, or installs
+    centroids fitted by another process with `adopt()`. Until then every
+    user is in segment 0.
+    """
+
+    # Interests are tracked as bits of an int64 mask
+    MAX_INTERESTS = 63
+
+    def __init__(self, n_clusters=5, refit_interval=300.0, drift_threshold=1.5,
+                 growth_factor=2.0, random_state=42, initial_capacity=1024, interests=()):
+        self.n_clusters = n_clusters
+        self.refit_interval = refit_interval
+        self.drift_threshold = drift_threshold
+        self.growth_factor = growth_factor
+        self.random_state = random_state
+
+        self._lock = threading.RLock()
+        self._index = {}
+        self.user_ids = []
+        # Columns: budget, interest_count
+        self._features = np.zeros((initial_capacity, 2), dtype=np.float64)
+        self._labels = np.zeros(initial_capacity, dtype=np.int32)
+        self._masks = np.zeros(initial_capacity, dtype=np.int64)
+        self.interests = list(interests)
+        self._interest_bits = {name: bit for bit, name in enumerate(self.interests)}
+        self.stats = SegmentStatistics(self.interests)
+
+        self._coef = None
+        self._intercept = 0.0
+
+        self._centroids = None
+        self._center_counts = None
+        self._baseline_error = 0.0
+        self._recent_error = 0.0
+        self._fitted_size = 0
+        self._last_refit = 0.0
+        self._writes_since_refit = 0
+        self._stale = True
+        self.refits = 0
+        self.refit_seconds = 0.0
+        self.background_refit = False
+        # Bumped on every change to the rows / to the clustering features
+        self._version = 0
+        self._model_version = 0
+        # Rows ordered by user ID for paging, as raw 32-byte digests. New
+        # users go to a small sorted tail that is merged into the main run
+        # once it outgrows a fraction of it.
+        self._sorted_keys = np.array([], dtype="S32")
+        self._sorted_rows = np.array([], dtype=np.int64)
+        self._tail_keys = np.array([], dtype="S32")
+        self._tail_rows = np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def set_model(self, coef, intercept):
+        """Use the global model prediction as an extra clustering feature."""
+        with self._lock:
+            coef = np.asarray(coef, dtype=np.float64)
+            if coef.shape != (self._features.shape[1],):
+                # The model was trained on a different feature space; it
+                # cannot be used as a clustering feature.
+                coef = None
+            self._coef = coef
+            self._intercept = float(intercept)
+            self._model_version += 1
+            self._stale = True
+
+    def _design(self, X):
+        if self._coef is None:
+            return X
+        prediction = X @ self._coef + self._intercept
+        return np.column_stack([X, prediction])
+
+    def _grow(self, needed):
+        capacity = len(self._labels)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        features = np.zeros((capacity, self._features.shape[1]), dtype=np.float64)
+        features[:len(self.user_ids)] = self._features[:len(self.user_ids)]
+        labels = np.zeros(capacity, dtype=np.int32)
+        labels[:len(self.user_ids)] = self._labels[:len(self.user_ids)]
+        masks = np.zeros(capacity, dtype=np.int64)
+        masks[:len(self.user_ids)] = self._masks[:len(self.user_ids)]
+        self._features = features
+        self._labels = labels
+        self._masks = masks
+
+    def interest_mask(self, interests):
+        mask = 0
+        for name in interests:
+            bit = self._interest_bits.get(name)
+            if bit is None:
+                if len(self.interests) >= self.MAX_INTERESTS:
+                    continue
+                bit = len(self.interests)
+                self.interests.append(name)
+                self._interest_bits[name] = bit
+            mask |= 1 << bit
+        return mask
+
+    def upsert(self, user_id, budget, interests):
+        """Insert or update a user's feature row and assign it to a segment."""
+        with self._lock:
+            mask = self.interest_mask(interests)
+            row = self._index.get(user_id)
+            if row is None:
+                row = len(self.user_ids)
+                self._grow(row + 1)
+                self._index[user_id] = row
+                self.user_ids.append(user_id)
+            else:
+                self.stats.remove(int(self._labels[row]), float(self._features[row, 0]), int(self._masks[row]))
+            self._features[row] = (budget, len(interests))
+            self._masks[row] = mask
+            self._writes_since_refit += 1
+            self._version += 1
+
+            if self._centroids is None:
+                self._labels[row] = 0
+                self.stats.add(0, budget, mask)
+                return
+            x = self._design(self._features[row:row + 1])[0]
+            distances = ((self._centroids - x) ** 2).sum(axis=1)
+            nearest = int(np.argmin(distances))
+            self._labels[row] = nearest
+            self.stats.add(nearest, budget, mask)
+
+            # Online k-means step with a per-centroid learning rate
+            self._center_counts[nearest] += 1
+            eta = 1.0 / self._center_counts[nearest]
+            self._centroids[nearest] += eta * (x - self._centroids[nearest])
+
+            # Exponentially weighted error of new points, compared against
+            # the mean error at the last full refit to detect drift.
+            self._recent_error = 0.95 * self._recent_error + 0.05 * float(distances[nearest])
+
+    def load(self, user_ids, budgets, interests):
+        """Bulk-load rows given interest lists; see load_columns."""
+        with self._lock:
+            masks = [self.interest_mask(user_interests) for user_interests in interests]
+            counts = [len(user_interests) for user_interests in interests]
+            self.load_columns(user_ids, budgets, masks, counts)
+
+    def load_columns(self, user_ids, budgets, masks, interest_counts=None):
+        """
+        Bulk-load feature rows, e.g. when warming the cache from the user store.
+        Masks use the engine's interest vocabulary; when no counts are given
+        they are taken from the number of bits set. Rows are written with array
+        assignments and the engine is marked stale, so labels and stats are
+        rebuilt by the next refit.
+        """
+        masks = np.asarray(masks, dtype=np.int64)
+        if interest_counts is None:
+            interest_counts = sum((masks >> bit) & 1 for bit in range(len(self.interests)))
+        with self._lock:
+            rows = np.empty(len(user_ids), dtype=np.int64)
+            new_ids = []
+            next_row = len(self.user_ids)
+            for i, user_id in enumerate(user_ids):
+                row = self._index.get(user_id)
+                if row is None:
+                    row = self._index[user_id] = next_row
+                    new_ids.append(user_id)
+                    next_row += 1
+                rows[i] = row
+            self._grow(next_row)
+            self.user_ids.extend(new_ids)
+            self._features[rows, 0] = budgets
+            self._features[rows, 1] = interest_counts
+            self._masks[rows] = masks
+            self._writes_since_refit += len(user_ids)
+            self._version += 1
+            self._stale = True
+
+    def _assign_all(self):
+        size = len(self.user_ids)
+        if self._centroids is None:
+            self._labels[:size] = 0
+            self.stats.rebuild(self._labels[:size], self._features[:size, 0], self._masks[:size])
+            return
+        self._labels[:size], _ = nearest_centroids(self._design(self._features[:size]), self._centroids)
+        self.stats.rebuild(self._labels[:size], self._features[:size, 0], self._masks[:size])
+        self._center_counts = np.bincount(self._labels[:size], minlength=len(self._centroids)).astype(np.float64)
+
+    def reassign(self):
+        """
+        Assign every row to the nearest current centroid and rebuild the stats,
+        e.g. after bulk loads. Before the first fit every row goes to segment
+        0, as with upsert(). The engine stays stale, so a full refit is still
+        due.
+        """
+        with self._lock:
+            self._assign_all()
+
+    def upsert_many(self, user_ids, budgets, interests):
+        """Apply a batch of writes while holding the lock only once."""
+        with self._lock:
+            for user_id, budget, user_interests in zip(user_ids, budgets, interests):
+                self.upsert(user_id, float(budget), user_interests)
+
+    def needs_refit(self):
+        with self._lock:
+            size = len(self.user_ids)
+            if size == 0:
+                return False
+            if self._stale or self._centroids is None:
+                return True
+            if size >= self._fitted_size * self.growth_factor:
+                return True
+            if self._writes_since_refit and time.monotonic() - self._last_refit >= self.refit_interval:
+                return True
+            if self._baseline_error > 0 and self._recent_error > self.drift_threshold * self._baseline_error:
+                return True
+            return False
+
+    def refit(self):
+        """Run a full KMeans fit over the current feature matrix."""
+        # Imported here so that importing the engine stays cheap
+        from sklearn.cluster import KMeans
+        with self._lock:
+            size = len(self.user_ids)
+            if size == 0:
+                return
+            started = time.perf_counter()
+            X = self._design(self._features[:size])
+            kmeans = KMeans(n_clusters=min(self.n_clusters, size), random_state=self.random_state)
+            labels = kmeans.fit_predict(X)
+
+            self._labels[:size] = labels
+            self.stats.rebuild(labels, self._features[:size, 0], self._masks[:size])
+            self._centroids = kmeans.cluster_centers_.astype(np.float64)
+            self._center_counts = np.bincount(labels, minlength=len(self._centroids)).astype(np.float64)
+            self._installed(float(kmeans.inertia_) / size)
+            self.refits += 1
+            self.refit_seconds += time.perf_counter() - started
+
+    def _refit_if_due(self):
+        if self.background_refit:
+            return
+        if self.needs_refit():
+            self.refit()
+
+    def fit_snapshot(self):
+        """
+        Copy out what an out-of-process fit needs: (X, budgets, masks,
+        interests, token), where X is the clustering design matrix and the
+        token identifies this state for publish().
+        """
+        with self._lock:
+            size = len(self.user_ids)
+            X = self._design(self._features[:size]).copy()
+            return (X, self._features[:size, 0].copy(), self._masks[:size].copy(), list(self.interests),
+                    (size, self._version, self._model_version))
+
+    def _design_width(self):
+        return self._features.shape[1] + (self._coef is not None)
+
+    def _installed(self, baseline_error):
+        self._baseline_error = baseline_error
+        self._recent_error = baseline_error
+        self._fitted_size = len(self.user_ids)
+        self._last_refit = time.monotonic()
+        self._writes_since_refit = 0
+        self._stale = False
+
+    def publish(self, centroids, labels, stats, inertia, token):
+        """
+        Install a fit of the snapshot identified by `token`. If rows or the
+        model features changed since the snapshot, every row is reassigned
+        to the new centroids under the current features and the stats
+        rebuilt. The result is only discarded when the feature space itself
+        changed (the model prediction column was added or dropped). Returns
+        whether it was installed.
+        """
+        size, version, model_version = token
+        with self._lock:
+            centroids = np.asarray(centroids, dtype=np.float64)
+            if size > len(self.user_ids) or centroids.shape[1] != self._design_width():
+                return False
+            if version == self._version and model_version == self._model_version:
+                self._labels[:size] = labels
+                stats.vocabulary = self.interests
+                self.stats = stats
+                self._centroids = centroids
+                self._center_counts = np.bincount(labels, minlength=len(centroids)).astype(np.float64)
+            else:
+                self._centroids = centroids
+                self._assign_all()
+            self._installed(float(inertia) / size if size else 0.0)
+            self.refits += 1
+            return True
+
+    def adopt(self, centroids, baseline_error):
+        """
+        Install centroids fitted by another process sharing the user store;
+        every row is reassigned to them. Returns whether they were installed.
+        """
+        with self._lock:
+            centroids = np.asarray(centroids, dtype=np.float64)
+            if not len(self.user_ids) or centroids.shape[1] != self._design_width():
+                return False
+            self._centroids = centroids
+            self._assign_all()
+            self._installed(baseline_error)
+            return True
+
+    @staticmethod
+    def _merge_runs(keys, rows, new_keys, new_rows):
+        positions = np.searchsorted(keys, new_keys) + np.arange(len(new_keys))
+        merged_keys = np.empty(len(keys) + len(new_keys), dtype="S32")
+        merged_rows = np.empty(len(merged_keys), dtype=np.int64)
+        taken = np.zeros(len(merged_keys), dtype=bool)
+        taken[positions] = True
+        merged_keys[positions], merged_rows[positions] = new_keys, new_rows
+        merged_keys[~taken], merged_rows[~taken] = keys, rows
+        return merged_keys, merged_rows
+
+    def _user_order(self):
+        """
+        Bring the sorted runs up to date with the users added since the last
+        call; returns [(keys, rows), ...], each run sorted by key. User IDs are
+        the hex digests produced by the app's pseudonymization.
+        """
+        size = len(self.user_ids)
+        known = len(self._sorted_rows) + len(self._tail_rows)
+        if known < size:
+            new_keys = np.array([bytes.fromhex(user_id) for user_id in self.user_ids[known:size]], dtype="S32")
+            order = np.argsort(new_keys, kind="stable")
+            self._tail_keys, self._tail_rows = self._merge_runs(
+                self._tail_keys, self._tail_rows, new_keys[order], order + known)
+            if len(self._tail_keys) > max(1024, len(self._sorted_keys) // 8):
+                self._sorted_keys, self._sorted_rows = self._merge_runs(
+                    self._sorted_keys, self._sorted_rows, self._tail_keys, self._tail_rows)
+                self._tail_keys = self._tail_keys[:0]
+                self._tail_rows = self._tail_rows[:0]
+        return [(self._sorted_keys, self._sorted_rows), (self._tail_keys, self._tail_rows)]
+
+    def labels_page(self, after=None, limit=None):
+        """
+        Return (user IDs, labels, total rows) for up to `limit` users following
+        the user ID `after`, in user ID order, refitting first if due. Unlike row
+        numbers, the order is the same in every process holding the same users.
+        """
+        with self._lock:
+            self._refit_if_due()
+            runs = self._user_order()
+            after = None if after is None else bytes.fromhex(after)
+            keys, rows = [], []
+            for run_keys, run_rows in runs:
+                start = 0 if after is None else int(np.searchsorted(run_keys, after, side="right"))
+                stop = len(run_keys) if limit is None else min(len(run_keys), start + limit)
+                keys.append(run_keys[start:stop])
+                rows.append(run_rows[start:stop])
+            keys, rows = np.concatenate(keys), np.concatenate(rows)
+            order = np.argsort(keys, kind="stable")[:limit]
+            keys, rows = keys[order], rows[order]
+            # Read through a byte view: numpy drops trailing NUL bytes of S32 items
+            digests = keys.tobytes().hex()
+            ids = [digests[i:i + 64] for i in range(0, len(digests), 64)]
+            return ids, self._labels[rows], len(self.user_ids)
+
+    def predict(self, user_id):
+        """
+        Return the segment for one user from their cached feature row and the
+        current centroids, or None for an unknown user.
+        """
+        with self._lock:
+            row = self._index.get(user_id)
+            if row is None:
+                return None
+            if self._centroids is None:
+                if self.background_refit:
+                    return int(self._labels[row])
+                self.refit()
+            x = self._design(self._features[row:row + 1])[0]
+            return int(np.argmin(((self._centroids - x) ** 2).sum(axis=1)))
+
+    def user_segment(self, user_id):
+        """
+        Return (segment, stat summary of that segment) for one user, or None
+        for an unknown user. Uses the user's current label and never refits,
+        except for the first fit when there is no background job.
+        """
+        with self._lock:
+            row = self._index.get(user_id)
+            if row is None:
+                return None
+            if self._centroids is None and not self.background_refit:
+                self.refit()
+            label = int(self._labels[row])
+            stats = self.stats.segments.get(label)
+            return label, stats.summary() if stats is not None else None
+
+    def snapshot(self):
+        """
+        Return the overall and per-segment stat summaries, refitting first if due.
+        """
+        with self._lock:
+            self._refit_if_due()
+            segments = {label: stats.summary() for label, stats in sorted(self.stats.segments.items())}
+            return self.stats.overall.summary(), segments
@@ -0,0 +1,349 @@
+"""
+Sharded k-means refits for large user bases, run off the request path.
+
+The feature rows are split into contiguous shards, each held by a
+persistent worker process. Every Lloyd iteration the parent broadcasts the
+centroids, each shard returns its partial sufficient statistics (per-centroid
+sums and counts), and the parent merges them into the next centroids until
+they stop moving. A final pass assigns labels and builds each shard's
+per-segment budget/interest stats, which merge exactly like the running
+stats kept by the engine.
+
+Small inputs are fitted in the calling thread with the same code, since
+starting processes would cost more than the fit.
+"""
+import io
+import os
+import time
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from segmentation import nearest_centroids
+from running_stats import SegmentStatistics
+
+logger = logging.getLogger(__name__)
+
+# Name of the job lock and of the shared centroids in the user store
+JOB_NAME = "segmentation"
+
+
+def partial_sums(X, centroids, squared_norms=None):
+    """Per-centroid (sums, counts) of the rows nearest to it, plus the inertia."""
+    labels, distances = nearest_centroids(X, centroids, squared_norms)
+    sums = np.column_stack([np.bincount(labels, weights=X[:, column], minlength=len(centroids))
+                            for column in range(X.shape[1])])
+    counts = np.bincount(labels, minlength=len(centroids))
+    return sums, counts, float(distances.sum())
+
+
+def shard_results(X, budgets, masks, centroids, vocabulary):
+    """Final pass over one shard: (labels, SegmentStatistics, inertia)."""
+    labels, distances = nearest_centroids(X, centroids)
+    stats = SegmentStatistics(vocabulary)
+    stats.rebuild(labels, budgets, masks)
+    return labels, stats, float(distances.sum())
+
+
+def kmeans_plus_plus(X, n_clusters, rng, sample_size=10000):
+    """k-means++ seeding on a random sample of the rows."""
+    if len(X) > sample_size:
+        X = X[rng.choice(len(X), sample_size, replace=False)]
+    centroids = [X[rng.integers(len(X))]]
+    distances = ((X - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(1, n_clusters):
+        total = distances.sum()
+        index = rng.choice(len(X), p=distances / total) if total > 0 else rng.integers(len(X))
+        centroids.append(X[index])
+        distances = np.minimum(distances, ((X - X[index]) ** 2).sum(axis=1))
+    return np.array(centroids, dtype=np.float64)
+
+
+def _shard_worker(conn):
+    """Worker process loop; holds one shard's rows between commands."""
+    X = budgets = masks = squared_norms = None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        command = message[0]
+        if command == "stop":
+            return
+        try:
+            if command == "load":
+                _, X, budgets, masks = message
+                squared_norms = (X * X).sum(axis=1)
+                result = len(X)
+            elif command == "step":
+                result = partial_sums(X, message[1], squared_norms)
+            elif command == "finish":
+                result = shard_results(X, budgets, masks, message[1], message[2])
+                # The shard is only needed for one fit
+                X = budgets = masks = squared_norms = None
+            else:
+                raise ValueError(f"Unknown command {command}")
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+class ShardWorker:
+    def __init__(self, context):
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_shard_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send(self, *message):
+        self._conn.send(message)
+
+    def receive(self):
+        status, result = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Shard worker failed: {result}")
+        return result
+
+    def stop(self):
+        try:
+            self._conn.send(("stop",))
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+
+
+class ShardedKMeans:
+    """
+    Lloyd's k-means over row shards in `workers` persistent processes, started
+    on first use. Inputs with fewer than `min_shard_rows` rows per worker use
+    fewer shards, down to one shard fitted in-process.
+    """
+
+    def __init__(self, n_clusters=5, workers=None, max_iter=300, tol=1e-4, random_state=42,
+                 min_shard_rows=50000):
+        self.n_clusters = n_clusters
+        self.workers = workers or os.cpu_count() or 1
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+        self.min_shard_rows = min_shard_rows
+        self._pool = []
+        self._pool_pid = None
+
+    def _shard_workers(self, count):
+        # Worker processes belong to the process that started them
+        if self._pool_pid != os.getpid():
+            self._pool = []
+            self._pool_pid = os.getpid()
+        # Spawned, not forked: the parent is a multi-threaded web worker
+        context = multiprocessing.get_context("spawn")
+        self._pool = [worker for worker in self._pool if worker.process.is_alive()]
+        while len(self._pool) < count:
+            self._pool.append(ShardWorker(context))
+        return self._pool[:count]
+
+    def close(self):
+        if self._pool_pid == os.getpid():
+            for worker in self._pool:
+                worker.stop()
+        self._pool = []
+
+    def fit(self, X, budgets, masks, vocabulary):
+        """
+        Returns (centroids, labels, stats, inertia, iterations) for the rows of
+        X, with stats a merged SegmentStatistics over all shards.
+        """
+        try:
+            return self._fit(X, budgets, masks, vocabulary)
+        except Exception:
+            # Replies may still be pending on the pipes; start over next time
+            self.close()
+            raise
+
+    def _fit(self, X, budgets, masks, vocabulary):
+        n_clusters = min(self.n_clusters, len(X))
+        rng = np.random.default_rng(self.random_state)
+        centroids = kmeans_plus_plus(X, n_clusters, rng)
+        # Convergence threshold relative to the data's spread, as in scikit-learn
+        threshold = self.tol * float(X.var(axis=0).mean())
+
+        shard_count = max(1, min(self.workers, len(X) // self.min_shard_rows))
+        bounds = np.linspace(0, len(X), shard_count + 1).astype(np.int64)
+        if shard_count == 1:
+            workers = None
+            squared_norms = (X * X).sum(axis=1)
+
+            def step(centroids):
+                return [partial_sums(X, centroids, squared_norms)]
+        else:
+            workers = self._shard_workers(shard_count)
+            for worker, start, stop in zip(workers, bounds[:-1], bounds[1:]):
+                worker.send("load", X[start:stop], budgets[start:stop], masks[start:stop])
+            for worker in workers:
+                worker.receive()
+
+            def step(centroids):
+                for worker in workers:
+                    worker.send("step", centroids)
+                return [worker.receive() for worker in workers]
+
+        iterations = 0
+        for iterations in range(1, self.max_iter + 1):
+            parts = step(centroids)
+            sums = sum(part[0] for part in parts)
+            counts = sum(part[1] for part in parts)
+            updated = centroids.copy()
+            # Empty clusters keep their previous centroid
+            filled = counts > 0
+            updated[filled] = sums[filled] / counts[filled, None]
+            shift = float(((updated - centroids) ** 2).sum())
+            centroids = updated
+            if shift <= threshold:
+                break
+
+        if workers is None:
+            parts = [shard_results(X, budgets, masks, centroids, vocabulary)]
+        else:
+            for worker in workers:
+                worker.send("finish", centroids, vocabulary)
+            parts = [worker.receive() for worker in workers]
+        labels = np.concatenate([part[0] for part in parts])
+        stats = SegmentStatistics(vocabulary)
+        for _, shard_stats, _ in parts:
+            stats.merge(shard_stats)
+        inertia = sum(part[2] for part in parts)
+        return centroids, labels, stats, inertia, iterations
+
+
+def encode_centroids(centroids, baseline_error) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, centroids=centroids, baseline_error=baseline_error)
+    return buffer.getvalue()
+
+
+def decode_centroids(payload):
+    """Inverse of encode_centroids: (centroids, baseline_error)."""
+    with np.load(io.BytesIO(payload), allow_pickle=False) as data:
+        return data["centroids"], float(data["baseline_error"])
+
+
+class SegmentationJob:
+    """
+    Background thread that checks every `interval` seconds whether the
+    engine needs a refit and, if so, fits a snapshot with ShardedKMeans and
+    publishes the result into the engine atomically. `sync` is called at
+    the start of every run to apply writes the engine has not seen yet (e.g.
+    other processes' writes to a shared store), and `on_publish` after each
+    installed result, e.g. to invalidate cached responses. The first run
+    starts immediately, so the engine's first fit also happens here.
+
+    With a shared `store`, only the process holding the store's job lock
+    runs refits, and it writes each installed result's centroids to the
+    store. The jobs of the other processes (e.g. the other gunicorn workers)
+    adopt the latest centroids instead, which only reassigns their rows.
+    """
+
+    def __init__(self, engine, kmeans, interval=5.0, on_publish=None, store=None, sync=None):
+        self.engine = engine
+        self.kmeans = kmeans
+        self.interval = interval
+        self.on_publish = on_publish
+        self.sync = sync
+        self.store = store
+        self._thread = None
+        self._stopping = threading.Event()
+        self._adopted_version = 0
+
+        self.owner = False
+        self.runs = 0
+        self.published = 0
+        self.discarded = 0
+        self.adopted = 0
+        self.failed = 0
+        self.last_iterations = 0
+        self.last_timings = {}
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="segmentation-job", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.kmeans.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.sync is not None:
+                    self.sync()
+                self.owner = self.store is None or self.store.acquire_lock(JOB_NAME)
+                if not self.owner:
+                    self.adopt_shared()
+                elif self.engine.needs_refit():
+                    self.run_once()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Segmentation job failed: {str(e)}")
+            self._stopping.wait(self.interval)
+
+    def run_once(self) -> bool:
+        """Fit and publish one refit; returns whether the result was installed."""
+        timings = {}
+        started = time.perf_counter()
+        X, budgets, masks, interests, token = self.engine.fit_snapshot()
+        timings["snapshot"] = time.perf_counter() - started
+        if not len(X):
+            return False
+
+        started = time.perf_counter()
+        centroids, labels, stats, inertia, iterations = self.kmeans.fit(X, budgets, masks, interests)
+        timings["fit"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        installed = self.engine.publish(centroids, labels, stats, inertia, token)
+        timings["publish"] = time.perf_counter() - started
+
+        self.runs += 1
+        self.last_iterations = iterations
+        self.last_timings = timings
+        if not installed:
+            self.discarded += 1
+            return False
+        self.published += 1
+        if self.store is not None:
+            self.store.put_state(JOB_NAME, encode_centroids(centroids, inertia / len(X)))
+        if self.on_publish is not None:
+            self.on_publish()
+        return True
+
+    def adopt_shared(self) -> bool:
+        """Install the centroids last published to the store, if they are new."""
+        state = self.store.get_state(JOB_NAME)
+        if state is None or state[0] <= self._adopted_version:
+            return False
+        version, payload = state
+        centroids, baseline_error = decode_centroids(payload)
+        if not self.engine.adopt(centroids, baseline_error):
+            return False
+        self._adopted_version = version
+        self.adopted += 1
+        if self.on_publish is not None:
+            self.on_publish()
+        return True
+
+    def metrics(self):
+        return {
+            "runs": self.runs,
+            "published": self.published,
+            "discarded": self.discarded,
+            "adopted": self.adopted,
+            "failed": self.failed,
+            "owner": self.owner,
+            "last_iterations": self.last_iterations,
+            "last_timings": dict(self.last_timings),
+        }
@@ -1,7 +1,136 @@
+"""
+Seeded, vectorized generator of synthetic user populations.
+
+Users are drawn from a mixture of clusters. Each cluster has its own typical
+budget and interest profile, so segmentation has real structure to find.
+Records come out in column chunks (budget ranges, the averaged budget and
+interest bitmasks over the codec's vocabulary), and the same seed and chunk
+size always produce the same population.
+
+Loading straight into the encrypted store and the segmentation caches, for
+benchmark and staging data sets:
+
+    python synthetic_data.py --users 1000000 --store users.db --keyring keyring.json
+
+or writing an NDJSON body for POST /api/save-preferences/batch:
+
+    python synthetic_data.py --users 10000 --ndjson population.ndjson
+"""
+import os
+import sys
+import json
+import time
+import argparse
 import numpy as np
+from codec import INTEREST_VOCABULARY
+
+
+class PopulationChunk:
+    __slots__ = ("user_ids", "low", "high", "budgets", "masks")
+
+    def __init__(self, user_ids, low, high, budgets, masks):
+        self.user_ids = user_ids
+        self.low = low
+        self.high = high
+        # Average of the range, as computed by process_user_data
+        self.budgets = budgets
+        self.masks = masks
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def records(self, interests=INTEREST_VOCABULARY):
+        """The chunk as {"user_id", "prefs"} dicts, in the batch API's format."""
+        names = np.array(interests)
+        bits = (self.masks[:, None] >> np.arange(len(interests))) & 1
+        return [
+            {"user_id": user_id, "prefs": {"budget": [low, high], "interests": names[row.astype(bool)].tolist()}}
+            for user_id, low, high, row in zip(self.user_ids, self.low.tolist(), self.high.tolist(), bits)
+        ]
+
+
+def cluster_profiles(clusters, seed, interests=INTEREST_VOCABULARY, budget_range=(100, 1500)):
+    """
+    Draw per-cluster parameters: mixture weights, budget centers spread
+    log-uniformly over budget_range, and per-interest probabilities where
+    each cluster strongly favours one or two interests.
+    """
+    rng = np.random.default_rng(seed)
+    weights = rng.dirichlet(np.full(clusters, 2.0))
+    low, high = budget_range
+    centers = np.exp(rng.uniform(np.log(low * 1.5), np.log(high / 1.5), clusters))
+    probabilities = rng.uniform(0.02, 0.2, (clusters, len(interests)))
+    for cluster in range(clusters):
+        favourite = rng.choice(len(interests), size=rng.integers(1, 3), replace=False)
+        probabilities[cluster, favourite] = rng.uniform(0.6, 0.95, len(favourite))
+    return weights, centers, probabilities
+
+
+def generate_population(count, chunk_size=100000, seed=42, clusters=5, interests=INTEREST_VOCABULARY,
+                        budget_range=(100, 1500), budget_spread=0.25, id_prefix="synthetic_user_"):
+    """Yield PopulationChunk objects covering `count` users."""
+    weights, centers, probabilities = cluster_profiles(clusters, seed, interests, budget_range)
+    floor, ceiling = budget_range
+    for chunk_index, start in enumerate(range(0, count, chunk_size)):
+        size = min(chunk_size, count - start)
+        rng = np.random.default_rng([seed, chunk_index])
+        assignment = rng.choice(clusters, size=size, p=weights)
+
+        # Log-normal spread around the cluster's center, then a range around it
+        middle = centers[assignment] * np.exp(rng.normal(0.0, budget_spread, size))
+        half_width = middle * rng.uniform(0.05, 0.4, size)
+        low = np.clip(np.rint(middle - half_width), floor, ceiling - 1).astype(np.int64)
+        high = np.clip(np.rint(middle + half_width), low + 1, ceiling).astype(np.int64)
+
+        picks = rng.random((size, len(interests))) < probabilities[assignment]
+        # Everyone has at least one interest: fall back to the cluster's favourite
+        empty = ~picks.any(axis=1)
+        picks[empty, probabilities[assignment[empty]].argmax(axis=1)] = True
+        masks = (picks.astype(np.int64) << np.arange(len(interests))).sum(axis=1)
+
+        user_ids = [f"{id_prefix}{i}" for i in range(start, start + size)]
+        yield PopulationChunk(user_ids, low, high, (low + high) / 2, masks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--store", help="user store to load into (defaults to USER_STORE_PATH)")
+    parser.add_argument("--keyring", help="keyring file (defaults to KEYRING_FILE)")
+    parser.add_argument("--ndjson", help="write NDJSON batch records to this file ('-' for stdout) instead")
+    args = parser.parse_args()
+
+    chunks = generate_population(args.users, args.chunk_size, args.seed, args.clusters)
+    started = time.perf_counter()
+    if args.ndjson:
+        out = sys.stdout if args.ndjson == "-" else open(args.ndjson, "w")
+        try:
+            for chunk in chunks:
+                out.write("".join(json.dumps(record) + "\n" for record in chunk.records()))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"Wrote {args.users} records in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return
+
+    # The app reads its configuration at import time
+    if args.store:
+        os.environ["USER_STORE_PATH"] = args.store
+    if args.keyring:
+        os.environ["KEYRING_FILE"] = args.keyring
+    import app
+
+    app.init_state()
+    loaded = 0
+    for chunk in chunks:
+        loaded += app.ingest_columns(chunk.user_ids, chunk.budgets, chunk.masks)
+        elapsed = time.perf_counter() - started
+        print(f"{loaded} users loaded ({loaded / elapsed:.0f}/s)", file=sys.stderr)
+    print(f"Loaded {loaded} users into {app.USER_STORE_PATH} in {time.perf_counter() - started:.1f}s")
+
 
-def generate_synthetic_clients(num_clients):
-    return [{
-        'features': np.random.rand(10).tolist(),
-        'sensitive': np.random.choice([0,1])
-    } for _ in range(num_clients)]
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# test_codec.py
+import json
+import base64
+import pytest
+import numpy as np
+from cryptography.fernet import Fernet
+from codec import FORMAT_VERSION, PAYLOAD_BINARY, PAYLOAD_JSON, HEADER, Keyring, RecordCodec
+from user_store import MemoryUserStore
+from rotate_keys import reencrypt_store, retire_keys
+
+
+@pytest.fixture
+def keyring_path(tmp_path):
+    return str(tmp_path / "keyring.json")
+
+
+@pytest.fixture
+def codec(keyring_path):
+    return RecordCodec(Keyring.load(keyring_path))
+
+
+def legacy_record(key, record):
+    """A record as written before the versioned codec: raw Fernet token bytes."""
+    return base64.urlsafe_b64decode(Fernet(key).encrypt(json.dumps(record).encode()))
+
+
+def test_binary_round_trip(codec):
+    record = {"budget": 450.5, "interests": ["tech", "health"]}
+    blob = codec.encode(record)
+    assert HEADER.unpack_from(blob)[:2] == (FORMAT_VERSION, PAYLOAD_BINARY)
+    assert codec.decode(blob) == record
+
+
+def test_json_payload_for_unknown_interests(codec):
+    # Unknown or repeated interests cannot be represented by the bitmask
+    for record in ({"budget": 100.0, "interests": ["gardening"]},
+                   {"budget": 100.0, "interests": ["tech", "tech"]}):
+        blob = codec.encode(record)
+        assert HEADER.unpack_from(blob)[1] == PAYLOAD_JSON
+        assert codec.decode(blob) == record
+
+
+def test_ciphertext_is_authenticated(codec):
+    blob = bytearray(codec.encode({"budget": 1.0, "interests": []}))
+    blob[-1] ^= 1
+    with pytest.raises(Exception):
+        codec.decode(bytes(blob))
+
+
+def test_encode_columns_matches_encode(codec):
+    budgets = np.array([100.0, 250.5, 999.0])
+    masks = np.array([0b1, 0b10110, 0])
+    blobs = codec.encode_columns(budgets, masks)
+    assert [codec.decode(blob) for blob in blobs] == [
+        {"budget": 100.0, "interests": ["tech"]},
+        {"budget": 250.5, "interests": ["finance", "sports", "education"]},
+        {"budget": 999.0, "interests": []},
+    ]
+
+
+def test_decode_many_splits_binary_and_other_records(keyring_path):
+    legacy_key = Fernet.generate_key()
+    codec = RecordCodec(Keyring.load(keyring_path), legacy_key=legacy_key)
+    blobs = [
+        codec.encode({"budget": 10.0, "interests": ["tech"]}),
+        codec.encode({"budget": 20.0, "interests": ["gardening"]}),
+        legacy_record(legacy_key, {"budget": 30.0, "interests": ["finance"]}),
+        b"\x02\x01\x01\x00" + b"\x00" * 40,
+        codec.encode({"budget": 40.0, "interests": ["sports", "health"]}),
+    ]
+    indices, budgets, masks, others, failed = codec.decode_many(blobs)
+    assert indices.tolist() == [0, 4]
+    assert budgets.tolist() == [10.0, 40.0]
+    assert masks.tolist() == [0b1, 0b1100]
+    assert others == [(1, {"budget": 20.0, "interests": ["gardening"]}),
+                      (2, {"budget": 30.0, "interests": ["finance"]})]
+    assert failed == [3]
+
+
+def test_decode_many_empty(codec):
+    indices, budgets, masks, others, failed = codec.decode_many([])
+    assert len(indices) == len(budgets) == len(masks) == 0
+    assert others == [] and failed == []
+
+
+def test_legacy_records(keyring_path):
+    legacy_key = Fernet.generate_key()
+    blob = legacy_record(legacy_key, {"budget": 300.0, "interests": ["tech"]})
+    codec = RecordCodec(Keyring.load(keyring_path), legacy_key=legacy_key)
+    assert codec.decode(blob) == {"budget": 300.0, "interests": ["tech"]}
+    assert codec.needs_rotation(blob)
+    assert not codec.needs_rotation(codec.reencrypt(blob))
+    with pytest.raises(ValueError):
+        RecordCodec(Keyring.load(keyring_path)).decode(blob)
+
+
+def test_old_keys_still_decrypt_after_rotation(keyring_path):
+    keyring = Keyring.load(keyring_path)
+    codec = RecordCodec(keyring)
+    blob = codec.encode({"budget": 5.0, "interests": []})
+    keyring.add_key()
+    keyring.save()
+    rotated = RecordCodec(Keyring.load(keyring_path))
+    assert rotated.needs_rotation(blob)
+    assert rotated.decode(blob) == {"budget": 5.0, "interests": []}
+
+
+def test_reencrypt_store_and_retire_keys(tmp_path, keyring_path):
+    legacy_key = Fernet.generate_key()
+    legacy_key_path = tmp_path / "secret.key"
+    legacy_key_path.write_bytes(legacy_key)
+    keyring = Keyring.load(keyring_path)
+    codec = RecordCodec(keyring, legacy_key=legacy_key)
+    store = MemoryUserStore()
+    records = {f"{i:064x}": {"budget": float(i), "interests": ["tech"]} for i in range(20)}
+    for i, (user_id, record) in enumerate(records.items()):
+        store.put(user_id, legacy_record(legacy_key, record) if i % 4 == 0 else codec.encode(record))
+    seq = store.latest_seq()
+
+    keyring.add_key()
+    keyring.save()
+    # Old records are still under key 1 or in the legacy format
+    assert not retire_keys(store, keyring_path)
+
+    replaced, failed = reencrypt_store(store, keyring_path, str(legacy_key_path), workers=2, batch_size=6)
+    assert (replaced, failed) == (20, 0)
+    # Rerunning skips records already under the active key
+    assert reencrypt_store(store, keyring_path, str(legacy_key_path), workers=2) == (0, 0)
+    # Re-encryption leaves the sequence numbers alone
+    assert store.latest_seq() == seq
+
+    assert retire_keys(store, keyring_path)
+    retired = RecordCodec(Keyring.load(keyring_path))
+    assert list(retired.keyring.keys) == [2]
+    assert {user_id: retired.decode(store.get(user_id)) for user_id in records} == records
+
+
+def test_replace_records_skips_concurrent_writes(codec):
+    store = MemoryUserStore()
+    old = codec.encode({"budget": 1.0, "interests": []})
+    store.put("a" * 64, old)
+    # The user wrote new preferences after the rotation read the record
+    newer = codec.encode({"budget": 2.0, "interests": []})
+    store.put("a" * 64, newer)
+    assert store.replace_records([("a" * 64, old, codec.reencrypt(old))]) == 0
+    assert store.get("a" * 64) == newer
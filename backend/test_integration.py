@@ -30,7 +30,7 @@ def test_end_to_end():
 
     print("\nTest Results:")
     print(f"Total Users: {data['participants']}")
-    print(f"Segments: {len(set(data['segments']))} unique groups")
+    print(f"Segments: {len(data['segmentCounts'])} unique groups")
     print(f"Avg Budget: ${data['stats']['average_budget']:.2f}")
     print(f"Top Interest: {['Tech', 'Finance', 'Sports', 'Health', 'Education'][data['stats']['common_interests']-1]}")
 
@@ -0,0 +1,52 @@
+# test_model_registry.py
+import numpy as np
+import pytest
+from model_registry import ModelHistory, apply_payload, decode_model, encode_model
+
+
+def test_model_state_round_trip():
+    coef = np.array([0.1, -2.5, 3.0])
+    restored, intercept = decode_model(encode_model(coef, 0.75))
+    np.testing.assert_array_equal(restored, coef)
+    assert intercept == 0.75
+
+
+def test_shared_versions_give_matching_tags():
+    coef = np.arange(10, dtype=np.float64)
+    first, second = ModelHistory(), ModelHistory()
+    assert first.publish(coef, 1.0, version=7) == 7
+    assert second.publish(coef, 1.0, version=7) == 7
+    assert first.latest().tag == second.latest().tag
+    # Without a version, numbering continues from the last one
+    assert first.publish(coef + 1, 1.0) == 8
+
+
+def test_patch_between_snapshots():
+    history = ModelHistory()
+    base = np.zeros(100)
+    history.publish(base, 0.0, version=3)
+    base_tag = history.latest().tag
+    updated = base.copy()
+    updated[[5, 50]] = [1.5, -2.0]
+    history.publish(updated, 0.5, version=5)
+    snapshot = history.latest()
+    payload = history.patch_payload(base_tag, snapshot)
+    assert len(payload) < len(history.full_payload(snapshot))
+    version, coef, intercept = apply_payload(payload, base.astype("<f4"))
+    assert (version, intercept) == (5, 0.5)
+    np.testing.assert_array_equal(coef, updated.astype("<f4"))
+    # No patch against an unknown or newer base
+    assert history.patch_payload("v1.0000000000000000", snapshot) is None
+    assert history.patch_payload(snapshot.tag, history.get(base_tag)) is None
+
+
+def test_history_keeps_recent_snapshots():
+    history = ModelHistory(max_versions=2)
+    tags = []
+    for version in range(1, 4):
+        history.publish(np.full(4, version, dtype=np.float64), 0.0, version=version)
+        tags.append(history.latest().tag)
+    assert history.get(tags[0]) is None
+    assert history.get(tags[2]) is history.latest()
+    with pytest.raises(ValueError):
+        apply_payload(b"XXXX" + bytes(40))
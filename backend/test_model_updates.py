@@ -0,0 +1,84 @@
+# test_model_updates.py
+import struct
+import pytest
+import numpy as np
+from model_updates import HEADER, MAGIC, FLAG_SPARSE, decode_update, dequantize, encode_update, max_payload_size
+
+
+def header(dtype=0, flags=0, dim=4, nnz=4, scale=1.0, intercept=0.0, weight=1.0, magic=MAGIC):
+    return HEADER.pack(magic, dtype, flags, 0, dim, nnz, scale, intercept, weight)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_dense_round_trip(dtype):
+    coef = np.array([0.5, -0.25, 0.0, 1.0], dtype=np.float32)
+    payload, sent = encode_update(coef, intercept=0.125, dtype=dtype, weight=3.0)
+    update = decode_update(payload)
+    assert update.indices is None and update.dim == 4
+    assert (update.intercept, update.weight) == (0.125, 3.0)
+    np.testing.assert_array_equal(dequantize(update), sent)
+    np.testing.assert_allclose(sent, coef, atol=0.01)
+    assert len(payload) <= max_payload_size(4)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_sparse_round_trip(dtype):
+    coef = np.array([0.01, -2.0, 0.02, 0.0, 1.5, -0.03], dtype=np.float32)
+    payload, sent = encode_update(coef, dtype=dtype, top_k=2)
+    update = decode_update(payload)
+    assert update.indices.tolist() == [1, 4]
+    assert update.nnz == 2
+    # Coefficients that were not sent come back as an unchanged (zero) delta
+    np.testing.assert_allclose(sent, [0, -2.0, 0, 0, 1.5, 0], atol=0.02)
+    np.testing.assert_array_equal(dequantize(update), sent)
+
+
+def test_rejects_bad_header():
+    with pytest.raises(ValueError, match="shorter"):
+        decode_update(b"FLU1")
+    with pytest.raises(ValueError, match="Not a model update"):
+        decode_update(header(magic=b"XXXX") + bytes(16))
+    with pytest.raises(ValueError, match="Unknown value type"):
+        decode_update(header(dtype=7) + bytes(16))
+
+
+@pytest.mark.parametrize("fields", [
+    {"nnz": 3},                            # dense update must send every value
+    {"flags": FLAG_SPARSE, "nnz": 5},      # more values than dimensions
+])
+def test_rejects_bad_counts(fields):
+    with pytest.raises(ValueError, match="count"):
+        decode_update(header(**fields) + bytes(64))
+
+
+@pytest.mark.parametrize("fields", [
+    {"weight": 0.0}, {"weight": -1.0}, {"scale": float("nan")}, {"intercept": float("inf")},
+])
+def test_rejects_bad_scalars(fields):
+    with pytest.raises(ValueError, match="scale, intercept or weight"):
+        decode_update(header(**fields) + bytes(16))
+
+
+def test_rejects_length_mismatch():
+    with pytest.raises(ValueError, match="length"):
+        decode_update(header() + bytes(15))
+    with pytest.raises(ValueError, match="length"):
+        decode_update(header() + bytes(17))
+
+
+@pytest.mark.parametrize("indices", [[1, 1], [2, 1], [0, 4]])
+def test_rejects_bad_indices(indices):
+    payload = (header(flags=FLAG_SPARSE, nnz=2)
+               + struct.pack("<2I", *indices) + np.ones(2, dtype="<f4").tobytes())
+    with pytest.raises(ValueError, match="Indices"):
+        decode_update(payload)
+
+
+def test_rejects_non_finite_values():
+    values = np.array([1.0, np.inf, 0.0, 0.0], dtype="<f4")
+    with pytest.raises(ValueError, match="non-finite"):
+        decode_update(header() + values.tobytes())
+    # Finite float16 values that overflow once scaled
+    values = np.full(4, 60000, dtype="<f2")
+    with pytest.raises(ValueError, match="non-finite"):
+        decode_update(header(dtype=1, scale=1e35) + values.tobytes())
@@ -0,0 +1,166 @@
+# test_running_stats.py
+import math
+import pytest
+import numpy as np
+from running_stats import QuantileSketch, RunningStats, SegmentStatistics
+
+ACCURACY = 0.01
+
+
+@pytest.fixture
+def budgets():
+    return np.random.default_rng(7).lognormal(6, 1, 5000)
+
+
+def assert_close_quantiles(sketch, values, qs=(0.0, 0.1, 0.5, 0.9, 0.99, 1.0)):
+    ordered = np.sort(values)
+    for q in qs:
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= ACCURACY * abs(exact) + 1e-9
+
+
+def test_sketch_quantiles_within_relative_accuracy(budgets):
+    sketch = QuantileSketch(ACCURACY)
+    for value in budgets:
+        sketch.add(value)
+    assert sketch.count == len(budgets)
+    assert_close_quantiles(sketch, budgets)
+
+
+def test_sketch_add_many_matches_add(budgets):
+    one_by_one, vectorized = QuantileSketch(ACCURACY), QuantileSketch(ACCURACY)
+    values = np.concatenate([budgets, -budgets[:50], np.zeros(10)])
+    for value in values:
+        one_by_one.add(value)
+    vectorized.add_many(values)
+    assert vectorized.to_dict() == one_by_one.to_dict()
+    assert vectorized.count == one_by_one.count
+
+
+def test_sketch_remove_undoes_add(budgets):
+    sketch = QuantileSketch(ACCURACY)
+    sketch.add_many(budgets)
+    extra = [-5.0, 0.0, 1e6]
+    for value in extra:
+        sketch.add(value)
+    for value in extra:
+        sketch.remove(value)
+    expected = QuantileSketch(ACCURACY)
+    expected.add_many(budgets)
+    assert sketch.to_dict() == expected.to_dict()
+    assert sketch.count == len(budgets)
+
+
+def test_sketch_merge(budgets):
+    left, right = QuantileSketch(ACCURACY), QuantileSketch(ACCURACY)
+    left.add_many(budgets[:2000])
+    right.add_many(budgets[2000:])
+    left.merge(right)
+    assert left.count == len(budgets)
+    assert_close_quantiles(left, budgets)
+    with pytest.raises(ValueError):
+        left.merge(QuantileSketch(0.05))
+
+
+def test_sketch_dict_round_trip(budgets):
+    sketch = QuantileSketch(ACCURACY)
+    sketch.add_many(np.concatenate([budgets, [-1.0, 0.0]]))
+    restored = QuantileSketch.from_dict(sketch.to_dict())
+    assert restored.count == sketch.count
+    assert restored.quantile(0.5) == sketch.quantile(0.5)
+
+
+def test_empty_sketch_quantile_is_nan():
+    assert math.isnan(QuantileSketch().quantile(0.5))
+
+
+def test_running_stats_match_numpy(budgets):
+    stats = RunningStats(ACCURACY)
+    for value in budgets:
+        stats.add(value, ["tech"])
+    assert stats.count == len(budgets)
+    assert stats.mean == pytest.approx(budgets.mean())
+    assert stats.variance == pytest.approx(budgets.var(ddof=1))
+    assert (stats.min, stats.max) == (budgets.min(), budgets.max())
+    assert stats.median == pytest.approx(np.median(budgets), rel=ACCURACY)
+
+
+def test_running_stats_merge_matches_single_pass(budgets):
+    left = RunningStats.from_arrays(budgets[:1000], {"tech": 3})
+    right = RunningStats.from_arrays(budgets[1000:], {"tech": 1, "health": 5})
+    left.merge(right)
+    whole = RunningStats.from_arrays(budgets, {"tech": 4, "health": 5})
+    assert left.count == whole.count
+    assert left.mean == pytest.approx(whole.mean)
+    assert left.variance == pytest.approx(whole.variance)
+    assert (left.min, left.max) == (whole.min, whole.max)
+    assert left.sketch.to_dict() == whole.sketch.to_dict()
+    assert left.interests == whole.interests
+    assert left.common_interest() == "health"
+
+
+def test_running_stats_merge_into_empty(budgets):
+    stats = RunningStats()
+    stats.merge(RunningStats())
+    assert stats.count == 0
+    stats.merge(RunningStats.from_arrays(budgets))
+    assert stats.mean == pytest.approx(budgets.mean())
+
+
+def test_running_stats_remove(budgets):
+    stats = RunningStats.from_arrays(budgets, {"tech": len(budgets)})
+    removed = budgets[:100]
+    for value in removed:
+        stats.remove(value, ["tech"])
+    rest = budgets[100:]
+    assert stats.count == len(rest)
+    assert stats.mean == pytest.approx(rest.mean())
+    assert stats.variance == pytest.approx(rest.var(ddof=1))
+    assert stats.interests == {"tech": len(rest)}
+
+
+def test_running_stats_remove_extremes_falls_back_to_sketch():
+    stats = RunningStats(ACCURACY)
+    for value in (10.0, 20.0, 30.0, 40.0):
+        stats.add(value)
+    stats.remove(10.0)
+    stats.remove(40.0)
+    assert stats.min == pytest.approx(20.0, rel=ACCURACY)
+    assert stats.max == pytest.approx(30.0, rel=ACCURACY)
+
+
+def test_running_stats_remove_last_resets():
+    stats = RunningStats()
+    stats.add(100.0, ["tech"])
+    stats.remove(100.0, ["tech"])
+    assert stats.summary() == RunningStats().summary()
+    assert stats.common_interest() == "N/A"
+
+
+def test_common_interest_ties():
+    stats = RunningStats()
+    stats.add(1.0, ["sports", "finance"])
+    assert stats.common_interest() == "finance"
+    # Mixed name types are compared as strings rather than raising TypeError
+    stats.interests.update({1: 1})
+    assert stats.common_interest() == 1
+
+
+def test_segment_statistics_rebuild_matches_incremental(budgets):
+    vocabulary = ["tech", "health", "finance"]
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, 3, len(budgets))
+    masks = rng.integers(0, 8, len(budgets))
+    incremental = SegmentStatistics(vocabulary)
+    for label, budget, mask in zip(labels, budgets, masks):
+        incremental.add(int(label), budget, int(mask))
+    rebuilt = SegmentStatistics(vocabulary)
+    rebuilt.rebuild(labels, budgets, masks)
+    assert set(rebuilt.segments) == set(incremental.segments)
+    for label, stats in rebuilt.segments.items():
+        assert stats.count == incremental.segments[label].count
+        assert stats.mean == pytest.approx(incremental.segments[label].mean)
+        assert stats.interests == incremental.segments[label].interests
+
+    incremental.remove(int(labels[0]), budgets[0], int(masks[0]))
+    assert incremental.overall.count == len(budgets) - 1
@@ -0,0 +1,127 @@
+# test_segmentation.py
+import numpy as np
+import pytest
+from segmentation import SegmentationEngine
+from sharded_segmentation import JOB_NAME, SegmentationJob, ShardedKMeans
+from user_store import MemoryUserStore
+
+INTERESTS = ["tech", "health", "finance", "sports", "education"]
+
+
+def make_engine(users=600, background=True, seed=0):
+    rng = np.random.default_rng(seed)
+    engine = SegmentationEngine(n_clusters=3, interests=INTERESTS)
+    engine.background_refit = background
+    engine.load_columns([f"{i:064x}" for i in range(users)], rng.uniform(0, 1000, users),
+                        rng.integers(0, 32, users))
+    engine.reassign()
+    return engine
+
+
+def make_job(engine, store=None, sync=None):
+    return SegmentationJob(engine, ShardedKMeans(3, workers=1), interval=60, store=store, sync=sync)
+
+
+def test_reads_do_not_fit_inline_in_background_mode():
+    engine = make_engine()
+    overall, segments = engine.snapshot()
+    assert engine.refits == 0
+    # Before the first fit every user is in segment 0
+    assert list(segments) == [0] and segments[0]["count"] == overall["count"] == 600
+    assert engine.predict(f"{5:064x}") == 0
+    assert engine.labels_page(limit=10)[1].tolist() == [0] * 10
+
+
+def test_reads_fit_inline_without_background_job():
+    engine = make_engine(background=False)
+    _, segments = engine.snapshot()
+    assert engine.refits == 1
+    assert len(segments) == 3
+
+
+def test_job_syncs_before_fitting():
+    engine = make_engine(users=0)
+    rng = np.random.default_rng(1)
+
+    def sync():
+        engine.load_columns([f"{i:064x}" for i in range(300)], rng.uniform(0, 1000, 300),
+                            rng.integers(0, 32, 300))
+
+    job = make_job(engine, sync=sync)
+    job.sync()
+    assert engine.needs_refit()
+    assert job.run_once()
+    _, segments = engine.snapshot()
+    assert sum(stats["count"] for stats in segments.values()) == 300
+    assert not engine.needs_refit()
+
+
+def test_publish_after_concurrent_writes_reassigns():
+    engine = make_engine()
+    job = make_job(engine)
+    X, budgets, masks, interests, token = engine.fit_snapshot()
+    centroids, labels, stats, inertia, _ = job.kmeans.fit(X, budgets, masks, interests)
+    engine.upsert(f"{1000:064x}", 10.0, ["tech"])
+    assert engine.publish(centroids, labels, stats, inertia, token)
+    overall, segments = engine.snapshot()
+    assert overall["count"] == 601
+    assert sum(stats["count"] for stats in segments.values()) == 601
+
+
+def test_followers_adopt_shared_centroids():
+    store = MemoryUserStore()
+    owner, follower = make_engine(), make_engine()
+    owner_job, follower_job = make_job(owner, store), make_job(follower, store)
+    assert not follower_job.adopt_shared()
+    assert owner_job.run_once()
+    assert store.get_state(JOB_NAME) is not None
+    assert follower_job.adopt_shared()
+    assert follower.labels_page()[1].tolist() == owner.labels_page()[1].tolist()
+    # Nothing new to adopt
+    assert not follower_job.adopt_shared()
+    assert follower_job.metrics()["adopted"] == 1
+
+
+
+@pytest.mark.parametrize("after, expected", [(None, 0), (f"{9:064x}", 10), (f"{599:064x}", 600)])
+def test_labels_page_cursor(after, expected):
+    engine = make_engine()
+    ids, labels, total = engine.labels_page(after=after, limit=5)
+    assert total == 600
+    assert ids == [f"{i:064x}" for i in range(expected, min(expected + 5, 600))]
+    assert len(labels) == len(ids)
+
+
+def test_labels_page_follows_users_added_between_pages():
+    engine = make_engine(users=0, background=False)
+    rng = np.random.default_rng(3)
+    # Digests ending in zero bytes must survive the round trip through S32
+    user_ids = ["ab" + "00" * 31] + [bytes(rng.integers(0, 256, 32, dtype=np.uint8)).hex() for _ in range(5000)]
+    for start in range(0, len(user_ids), 700):
+        chunk = user_ids[start:start + 700]
+        engine.load_columns(chunk, rng.uniform(0, 1000, len(chunk)), rng.integers(0, 32, len(chunk)))
+        engine.labels_page(limit=1)
+    pages, after = [], None
+    while True:
+        ids, labels, total = engine.labels_page(after, 333)
+        if not ids:
+            break
+        pages.extend(ids)
+        after = ids[-1]
+    assert total == len(user_ids)
+    assert pages == sorted(user_ids)
+
+
+def test_user_segment_does_not_refit():
+    engine = make_engine()
+    job = make_job(engine)
+    assert job.run_once()
+    user_id = f"{7:064x}"
+    engine.upsert(f"{1000:064x}", 10.0, ["tech"])
+    refits = engine.refits
+    engine._stale = True
+    label, summary = engine.user_segment(user_id)
+    assert engine.refits == refits
+    assert label == engine.labels_page(after=f"{6:064x}", limit=1)[1][0]
+    assert summary == engine.snapshot()[1][label]
+    assert engine.user_segment("f" * 64) is None
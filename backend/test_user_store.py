@@ -0,0 +1,50 @@
+# test_user_store.py
+import pytest
+from user_store import MemoryUserStore, SQLiteUserStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = MemoryUserStore() if request.param == "memory" else SQLiteUserStore(str(tmp_path / "users.db"))
+    yield store
+    store.close()
+
+
+def test_put_and_scan_follow_seq(store):
+    ids = [f"{i:064x}" for i in range(5)]
+    assert store.put_many((user_id, b"r%d" % i) for i, user_id in enumerate(ids)) == (1, 5)
+    assert store.put(ids[0], b"new") == 6
+    assert store.get(ids[0]) == b"new" and store.get("f" * 64) is None
+    assert store.count() == 5 and store.latest_seq() == 6
+    rows = [row for batch in store.scan(since=3, batch_size=2) for row in batch]
+    assert rows == [(ids[3], b"r3", 4), (ids[4], b"r4", 5), (ids[0], b"new", 6)]
+
+
+def test_state_versions(store):
+    assert store.get_state("model") is None
+    assert store.put_state("model", b"one") == 1
+    assert store.put_state("model", b"two") == 2
+    assert store.get_state("model") == (2, b"two")
+    assert store.get_state("model", since=1) == (2, b"two")
+    # Nothing newer than the version already held
+    assert store.get_state("model", since=2) is None
+
+
+def test_message_queues(store):
+    assert store.take_messages("updates") == []
+    assert [store.push_message("updates", b"m%d" % i) for i in range(3)] == [1, 2, 3]
+    store.push_message("other", b"x")
+    assert store.count_messages("updates") == 3
+    assert store.take_messages("updates") == [b"m0", b"m1", b"m2"]
+    assert store.count_messages("updates") == 0
+    assert store.take_messages("other") == [b"x"]
+
+
+def test_sqlite_state_is_shared(tmp_path):
+    path = str(tmp_path / "users.db")
+    writer, reader = SQLiteUserStore(path), SQLiteUserStore(path)
+    writer.put_state("model", b"blob")
+    writer.push_message("updates", b"update")
+    assert reader.get_state("model") == (1, b"blob")
+    assert reader.take_messages("updates") == [b"update"]
+    assert writer.count_messages("updates") == 0
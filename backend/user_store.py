@@ -0,0 +1,388 @@
+import os
+import fcntl
+import sqlite3
+import threading
+
+
+class UserStore:
+    """
+    Storage backend for encrypted user records, keyed by pseudonymized user ID.
+
+    Every write is stamped with a monotonically increasing sequence number so
+    that processes sharing a store can catch up on each other's writes with
+    `scan(since=...)`.
+    """
+
+    def put(self, user_id: str, record: bytes) -> int:
+        """Store one record and return its sequence number."""
+        first, _ = self.put_many([(user_id, record)])
+        return first
+
+    def put_many(self, items) -> tuple:
+        """Store (user_id, record) pairs; return the (first, last) sequence numbers assigned."""
+        raise NotImplementedError
+
+    def get(self, user_id: str):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def latest_seq(self) -> int:
+        raise NotImplementedError
+
+    def size_bytes(self) -> int:
+        """Approximate storage footprint of the records, for monitoring."""
+        raise NotImplementedError
+
+    def scan(self, since: int = 0, batch_size: int = 10000):
+        """Yield lists of (user_id, record, seq) written after `since`, in seq order."""
+        raise NotImplementedError
+
+    def scan_records(self, batch_size: int = 10000):
+        """Yield lists of (key, record) over the whole store, for maintenance jobs."""
+        raise NotImplementedError
+
+    def replace_records(self, items) -> int:
+        """
+        Replace records in place given (key, old_record, new_record) triples,
+        skipping any record changed since it was read. Sequence numbers are left
+        alone since the plaintext is unchanged. Returns the number replaced.
+        """
+        raise NotImplementedError
+
+    def put_state(self, name: str, value: bytes) -> int:
+        """
+        Store a small named blob shared by every process using the store, e.g.
+        a model fitted by one of them. Returns the blob's new version.
+        """
+        raise NotImplementedError
+
+    def get_state(self, name: str, since: int = 0):
+        """
+        Return (version, value) of a named blob, or None if it was never
+        stored or has not changed since version `since`.
+        """
+        raise NotImplementedError
+
+    def push_message(self, queue: str, value: bytes) -> int:
+        """
+        Append a blob to the named queue shared by every process using the
+        store, e.g. a client update for whichever process aggregates them.
+        Returns the number of messages now waiting in the queue.
+        """
+        raise NotImplementedError
+
+    def take_messages(self, queue: str) -> list:
+        """Remove and return every message waiting in the queue, oldest first."""
+        raise NotImplementedError
+
+    def count_messages(self, queue: str) -> int:
+        raise NotImplementedError
+
+    def acquire_lock(self, name: str) -> bool:
+        """
+        Try, without blocking, to become the one process running the job
+        `name` against this store. Once acquired the lock is held until the
+        process exits, so another process takes over if the owner dies.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return self.count()
+
+
+class MemoryUserStore(UserStore):
+    """Process-local store, for tests and single-process development."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._seq = 0
+        self._bytes = 0
+        self._state = {}
+        self._queues = {}
+
+    def put_many(self, items):
+        with self._lock:
+            first = self._seq + 1
+            for user_id, record in items:
+                self._seq += 1
+                # Re-insert so iteration order follows seq order
+                old = self._records.pop(user_id, None)
+                if old is not None:
+                    self._bytes -= len(old[0])
+                self._records[user_id] = (bytes(record), self._seq)
+                self._bytes += len(record)
+            return first, self._seq
+
+    def get(self, user_id):
+        entry = self._records.get(user_id)
+        return entry[0] if entry else None
+
+    def count(self):
+        return len(self._records)
+
+    def latest_seq(self):
+        return self._seq
+
+    def size_bytes(self):
+        return self._bytes
+
+    def scan(self, since=0, batch_size=10000):
+        with self._lock:
+            rows = [(user_id, record, seq) for user_id, (record, seq) in self._records.items() if seq > since]
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    def scan_records(self, batch_size=10000):
+        for batch in self.scan(0, batch_size):
+            yield [(user_id, record) for user_id, record, _ in batch]
+
+    def replace_records(self, items):
+        replaced = 0
+        with self._lock:
+            for user_id, old_record, new_record in items:
+                entry = self._records.get(user_id)
+                if entry is not None and entry[0] == old_record:
+                    self._records[user_id] = (bytes(new_record), entry[1])
+                    self._bytes += len(new_record) - len(old_record)
+                    replaced += 1
+        return replaced
+
+
+    def put_state(self, name, value):
+        with self._lock:
+            version = self._state.get(name, (0, None))[0] + 1
+            self._state[name] = (version, bytes(value))
+            return version
+
+    def get_state(self, name, since=0):
+        state = self._state.get(name)
+        return state if state is not None and state[0] > since else None
+
+    def push_message(self, queue, value):
+        with self._lock:
+            messages = self._queues.setdefault(queue, [])
+            messages.append(bytes(value))
+            return len(messages)
+
+    def take_messages(self, queue):
+        with self._lock:
+            return self._queues.pop(queue, [])
+
+    def count_messages(self, queue):
+        return len(self._queues.get(queue, ()))
+
+    def acquire_lock(self, name):
+        # Nothing else can open a process-local store
+        return True
+
+
+class SQLiteUserStore(UserStore):
+    """
+    SQLite store in WAL mode, shared by every worker process on the host.
+
+    User IDs are stored as raw 32-byte digests and records as raw binary
+    ciphertext. Reads go through SQLite's memory-mapped I/O, so bulk scans
+    for segmentation do not copy pages through the read() syscall path.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_id BLOB NOT NULL UNIQUE,
+            record BLOB NOT NULL,
+            seq INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_seq ON users (seq);
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            value BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            queue TEXT NOT NULL,
+            value BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, id);
+    """
+
+    def __init__(self, path, mmap_size=1 << 30):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        # Job locks held by this process: name -> (file descriptor, pid)
+        self._locks = {}
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        # Connections must not be shared across a fork
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put_many(self, items):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            base = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM users").fetchone()[0]
+            rows = [(bytes.fromhex(user_id), bytes(record), base + offset)
+                    for offset, (user_id, record) in enumerate(items, start=1)]
+            conn.executemany(
+                "INSERT INTO users (user_id, record, seq) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET record = excluded.record, seq = excluded.seq",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return base + 1, base + len(rows)
+
+    def get(self, user_id):
+        row = self._connection().execute(
+            "SELECT record FROM users WHERE user_id = ?", (bytes.fromhex(user_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def latest_seq(self):
+        return self._connection().execute("SELECT COALESCE(MAX(seq), 0) FROM users").fetchone()[0]
+
+    def size_bytes(self):
+        conn = self._connection()
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        wal_path = self.path + "-wal"
+        wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        return page_count * page_size + wal_size
+
+    def scan(self, since=0, batch_size=10000):
+        conn = self._connection()
+        while True:
+            rows = conn.execute(
+                "SELECT user_id, record, seq FROM users WHERE seq > ? ORDER BY seq LIMIT ?",
+                (since, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [(user_id.hex(), record, seq) for user_id, record, seq in rows]
+            since = rows[-1][2]
+
+    def scan_records(self, batch_size=10000):
+        conn = self._connection()
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, record FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def replace_records(self, items):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.executemany(
+                "UPDATE users SET record = ? WHERE id = ? AND record = ?",
+                [(bytes(new_record), row_id, bytes(old_record)) for row_id, old_record, new_record in items],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    def put_state(self, name, value):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO state (name, version, value) VALUES (?, 1, ?) "
+                "ON CONFLICT (name) DO UPDATE SET version = version + 1, value = excluded.value",
+                (name, bytes(value)),
+            )
+            version = conn.execute("SELECT version FROM state WHERE name = ?", (name,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return version
+
+    def get_state(self, name, since=0):
+        row = self._connection().execute(
+            "SELECT version, value FROM state WHERE name = ? AND version > ?", (name, since)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def push_message(self, queue, value):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO messages (queue, value) VALUES (?, ?)", (queue, bytes(value)))
+            waiting = conn.execute("SELECT COUNT(*) FROM messages WHERE queue = ?", (queue,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return waiting
+
+    def take_messages(self, queue):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, value FROM messages WHERE queue = ? ORDER BY id", (queue,)).fetchall()
+            if rows:
+                conn.execute("DELETE FROM messages WHERE queue = ? AND id <= ?", (queue, rows[-1][0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [value for _, value in rows]
+
+    def count_messages(self, queue):
+        return self._connection().execute("SELECT COUNT(*) FROM messages WHERE queue = ?", (queue,)).fetchone()[0]
+
+    def acquire_lock(self, name):
+        held = self._locks.get(name)
+        # A lock inherited through a fork belongs to the parent
+        if held is not None and held[1] == os.getpid():
+            return True
+        fd = os.open(f"{self.path}.{name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Released by the OS when the process exits
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._locks[name] = (fd, os.getpid())
+        return True
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def open_user_store(path: str) -> UserStore:
+    if path == ":memory:":
+        return MemoryUserStore()
+    return SQLiteUserStore(path)